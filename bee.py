@@ -23,18 +23,43 @@ if sys.version_info < min_py:
 ###
 # Other standard distro imports
 ###
+from   array import array
 import argparse
-import contextlib
+import collections
+import glob
+import gzip
+import heapq
 import multiprocessing
+import json
 import platform
 import re
+import resource
+import signal
+import sqlite3
+import tempfile
+import threading
 import time
+import zlib
+
+###
+# Optional. The numpy engine is only available if it is installed.
+###
+try:
+    import numpy
+    we_have_numpy = True
+except ImportError as e:
+    we_have_numpy = False
 
 ###
 # From hpclib
 ###
 import sqlitedb
 
+###
+# From this project
+###
+import beeidx
+
 ###
 # Credits
 ###
@@ -60,112 +85,431 @@ else:
 db = None
 mylock = None
 mypid = os.getpid()
-SQL = "INSERT INTO answers (middle_letter, puzzle, matches, pid) VALUES (?, ?, ?, ?)"
+SQL = """INSERT INTO answers (middle_letter, puzzle, matches, pid, 
+    word_count, score, pangram_count, genius, hints) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+PANGRAM_SQL = "INSERT INTO pangrams (puzzle, word) VALUES (?, ?)"
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS answers (
+        middle_letter TEXT, puzzle TEXT, matches TEXT, pid INTEGER,
+        word_count INTEGER, score INTEGER, pangram_count INTEGER, genius INTEGER,
+        hints TEXT)""",
+    """CREATE TABLE IF NOT EXISTS pangrams (
+        puzzle TEXT, word TEXT)""",
+    """CREATE TABLE IF NOT EXISTS dictionary (
+        word TEXT PRIMARY KEY)""",
+    """CREATE TABLE IF NOT EXISTS dictionary_source (
+        checksum BLOB)""",
+    )
+INDEXES = (
+    """CREATE INDEX IF NOT EXISTS answers_puzzle 
+        ON answers (puzzle, middle_letter)""",
+    """CREATE INDEX IF NOT EXISTS answers_score ON answers (score)""",
+    """CREATE INDEX IF NOT EXISTS answers_word_count ON answers (word_count)""",
+    )
+
+###
+# Each answer row carries these aggregates, which are computed 
+# by puzzle_stats() as the rows are made. genius is the score
+# needed for that rank, and rank_thresholds() gives the others.
+# hints is the hint grid from hint_grid(), in the compact text
+# form of encode_hints().
+###
+AGGREGATE_COLUMNS = (('word_count', 'INTEGER'), ('score', 'INTEGER'), 
+    ('pangram_count', 'INTEGER'), ('genius', 'INTEGER'), ('hints', 'TEXT'))
+RANKS = (('Beginner', 0.0), ('Good Start', 0.02), ('Moving Up', 0.05), 
+    ('Good', 0.08), ('Solid', 0.15), ('Nice', 0.25), ('Great', 0.40), 
+    ('Amazing', 0.50), ('Genius', 0.70), ('Queen Bee', 1.0))
+
+###
+# The compact schema (--schema compact) stores each answer list
+# as the sorted ids of its words in the words table, delta encoded
+# as varints, in a BLOB. word_ids is word -> id for the encoding.
+###
+schema = 'text'
+word_ids = None
+COMPACT_SQL = """INSERT INTO compact_answers (middle_letter, puzzle, matches, pid,
+    word_count, score, pangram_count, genius, hints) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+WORD_SQL = "INSERT OR IGNORE INTO words (word) VALUES (?)"
+COMPACT_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS words (
+        id INTEGER PRIMARY KEY, word TEXT NOT NULL UNIQUE)""",
+    """CREATE TABLE IF NOT EXISTS compact_answers (
+        middle_letter TEXT, puzzle TEXT, matches BLOB, pid INTEGER,
+        word_count INTEGER, score INTEGER, pangram_count INTEGER, genius INTEGER,
+        hints TEXT)""",
+    )
+COMPACT_INDEXES = (
+    """CREATE INDEX IF NOT EXISTS compact_answers_puzzle 
+        ON compact_answers (puzzle, middle_letter)""",
+    """CREATE INDEX IF NOT EXISTS compact_answers_score ON compact_answers (score)""",
+    """CREATE INDEX IF NOT EXISTS compact_answers_word_count ON compact_answers (word_count)""",
+    )
 start_time = time.time()
 verbose = False
 
-def analyze_pangrams(pangrams:tuple, words:tuple) -> int:
-    """
-    Take some pangrams and see how many words we can find 
-    when using each one in the SpellingBee program.
+###
+# The checksum of the .bee file that load_dictionary() read. The
+# dictionary_source table keeps the one the answers were made from.
+###
+dict_checksum = None
+
+###
+# Answers found in the database are kept in answer_cache, which
+# is a least recently used cache of (puzzle, middle_letter) -> 
+# sorted answers, holding at most answer_cache_size puzzles. It 
+# pays in a process that answers many puzzles, i.e., beeserver.py,
+# whose handlers are threads; hence the lock.
+###
+answer_cache = collections.OrderedDict()
+answer_cache_size = 4096
+answer_cache_lock = threading.Lock()
+
+###
+# In batch mode, the workers send their results through 
+# results_queue, send_size rows at a time, to one writer process 
+# that owns the only connection to the database. The writer 
+# buffers the rows, and writes them with executemany in one 
+# transaction when there are batch_size answer rows waiting, or 
+# flush_interval seconds have gone by. Set from --batch-size 
+# and --flush-interval.
+###
+results_queue = None
+send_size = 1000
+
+###
+# With --shards DIR there is no writer. Each worker appends its
+# (middle_letter, puzzle, matches) records, one JSON array per 
+# line, to its own DIR/shard.PID.jsonl.gz, and --merge DIR loads
+# all the shards into the database afterwards. A worker told to stop
+# with SIGTERM finishes the chunk it has, so its shard ends with a
+# whole letter set, and a whole gzip member.
+###
+shard_dir = ""
+shard = None
+shard_stopping = False
+
+###
+# Workers claim chunk_size letter sets at a time from the shared
+# counter, so no worker sits idle while there is work left. Set
+# from --chunk-size.
+###
+chunk_counter = None
+chunk_size = 50
+
+###
+# Each process in a batch run accumulates its own run_stats, and
+# sends them to the parent through stats_queue when it is done.
+# done_counter is the number of letter sets finished, which the 
+# parent reports every progress_interval seconds. Set from 
+# --stats and --progress.
+###
+run_stats = collections.defaultdict(int)
+stats_queue = None
+done_counter = None
+progress_interval = 5.0
+
+batch_size = 10000
+flush_interval = 5.0
+pending_answers = []
+pending_pangrams = []
+last_flush = time.time()
+
+###
+# Each word is reduced to a 26-bit mask of the letters in it, 
+# a = bit 0 ... z = bit 25. Anything that is not a-z sets the
+# foreign bit, and because no puzzle ever contains that bit, 
+# such a word can never be an answer. 
+###
+letter_bits = {c:1 << i for i, c in enumerate('abcdefghijklmnopqrstuvwxyz')}
+foreign_bit = 1 << 26
+
+# The engine used to solve puzzles; set from --engine.
+engine = 'subset'
+
+# For the subset engine: mask -> positions of the words having 
+# exactly those letters. Built once by group_by_mask().
+mask_groups = None
+
+# For the numpy engine: the masks as a uint32 numpy array.
+numpy_masks = None
 
-    For each pangram, we successively treat each letter
-    as the middle one as the inner for-loop runs. 
+###
+# For the trie engine, and for --prefix: a trie of nested dicts,
+# one level per letter. The key '' marks the end of a word, and
+# its value is the word. Built once by build_trie().
+###
+word_trie = None
+
+def analyze_pangrams(letter_sets:tuple, words:Sequence, masks:Sequence) -> int:
+    """
+    Take some letter sets and see how many words we can find 
+    when using each one in the SpellingBee program. letter_sets
+    is a tuple of (sorted letters, pangrams having those letters),
+    so each puzzle is solved only once no matter how many pangrams 
+    share it. The work is claimed a chunk at a time with next_chunk().
+
+    For each letter set, we successively treat each letter
+    as the middle one. 
     """
     global verbose
-    global db
+    global results_queue
+    global shard_dir
+    global shard
+    global shard_stopping
+    global run_stats
+    global done_counter
 
     try:
-        print(f"Child process {os.getpid()} is analyzing {len(pangrams)} pangrams.")
-        for pangram in pangrams:
-            pangram = "".join(set(pangram))
-            db and db.execute_SQL("BEGIN EXCLUSIVE TRANSACTION")
-            expression = re.compile(f"[{pangram}]*")
-            all_matches = set(_ for _ in words if expression.fullmatch(_))
-            for required_letter in pangram:
-                matches = tuple(word for word in all_matches if required_letter in word)
-                db and write_results(required_letter, "".join(sorted(pangram)), matches)
-            db and robust_commit()
+        if shard_dir:
+            shard = gzip.open(os.path.join(shard_dir, f"shard.{os.getpid()}.jsonl.gz"),
+                'at', compresslevel=1, encoding='utf-8')
+            signal.signal(signal.SIGTERM, stop_shard)
+
+        while not shard_stopping and (chunk := next_chunk(letter_sets)):
+            for puzzle, pangrams in chunk:
+                start = time.perf_counter()
+                solutions = solve_letter_set(puzzle, words, masks)
+                run_stats['compute_seconds'] += time.perf_counter() - start
+
+                for required_letter, matches in solutions.items():
+                    results_queue and write_results(required_letter, puzzle, matches)
+                    shard and write_shard(required_letter, puzzle, matches)
+                results_queue and write_pangrams(puzzle, pangrams)
+                run_stats['pangrams'] += len(pangrams)
+
+            run_stats['letter_sets'] += len(chunk)
+            with done_counter.get_lock():
+                done_counter.value += len(chunk)
+        print(f"Child process {os.getpid()} analyzed {run_stats['letter_sets']} letter sets.")
 
     except KeyboardInterrupt as e:
         print("You pressed control-C")        
 
     finally:
-        db.close()
+        results_queue and send_results(force=True)
+        shard and shard.close()
+        send_stats('worker')
         os._exit(os.EX_OK)
 
 
-def beehive(myargs:argparse.Namespace, words:tuple) -> int:
+def answer_row(letter:str, pangram:str, results:tuple) -> tuple:
+    """
+    The row for SQL, encoded for whichever schema is in use.
+    """
+    global mypid
+    global schema
+    global word_ids
+
+    stats = puzzle_stats(results)
+    hints = encode_hints(hint_grid(results))
+    if schema == 'compact':
+        results = encode_word_ids(word_ids[word] for word in results)
+    else:
+        results = " ".join(results)
+    return (letter, pangram, results, mypid) + stats + (hints,)
+
+
+def beehive(myargs:argparse.Namespace, words:Sequence, masks:Sequence) -> int:
     """
     Try every pangram in the dictionary against the entire list of words.
     """
     global verbose
+    global db
     global mypid
-    global mylock
+    global results_queue
+    global chunk_counter
+    global stats_queue
+    global done_counter
+    global progress_interval
 
     num_cpus = myargs.cpus if myargs.batch else 1
     print(f"Using {num_cpus} processes.")
 
-    pangrams = tuple(_ for _ in words if len(set(_)) == 7)
-    verbose and print(f"The dictionary contains {len(pangrams)} pangrams")    
+    letter_sets = pangram_letter_sets(words, masks)
+    verbose and print(f"The dictionary contains {sum(len(_) for _ in letter_sets.values())} pangrams"
+        f" with {len(letter_sets)} distinct letter sets.")
+    if db and not shard_dir:
+        letter_sets = resume_letter_sets(letter_sets, words)
+        if letter_sets is None:
+            print(f"{db} has answers from another dictionary. Use --update, or a new database.")
+            return os.EX_DATAERR
+    letter_sets = tuple(letter_sets.items())
+    chunk_counter = multiprocessing.Value('q', 0)
+    done_counter = multiprocessing.Value('q', 0)
+    stats_queue = multiprocessing.SimpleQueue()
+
+    ###
+    # Shards are written without the database; --merge records the
+    # dictionary when it loads them.
+    ###
+    if shard_dir:
+        os.makedirs(shard_dir, exist_ok=True)
+        if glob.glob(os.path.join(shard_dir, "shard.*.jsonl.gz")):
+            print(f"{shard_dir} already has shards in it. Merge them, or remove them.")
+            return os.EX_CANTCREAT
+    if db and not shard_dir: 
+        record_dictionary(words)
+    if db and not shard_dir and schema == 'compact':
+        load_word_ids(words)
+
+    ###
+    # The writer is the only process that uses the database. It
+    # gets a connection of its own the first time it does.
+    ###
+    writer_pid = None
+    writer_OK = True
+    if db and not shard_dir:
+        db.commit()
+        results_queue = multiprocessing.SimpleQueue()
+        writer_pid = os.fork()
+        if not writer_pid:
+            mypid = os.getpid()
+            write_queue()
 
     mypids = set()
-    for block in splitter(pangrams, num_cpus):
+    for _ in range(num_cpus):
         pid = os.fork()
         if pid: 
             mypids.add(pid)
         else:
-            # These objects are distinct in the child processes. Each
-            # child has its own lock instance that references the 
-            # the singleton lock.
             mypid = os.getpid()
-            mylock = multiprocessing.RLock()
-            analyze_pangrams(block, words)
+            analyze_pangrams(letter_sets, words, masks)
 
+    next_report = time.time() + progress_interval
     while mypids:
-        child_pid, status, _ = os.wait3(0)
+        child_pid, status, _ = os.wait3(os.WNOHANG)
+        if not child_pid:
+            if progress_interval and time.time() >= next_report:
+                report_progress(len(letter_sets))
+                next_report += progress_interval
+            time.sleep(0.05)
+            continue
+
         exit_code, signal_number = divmod(status, 256)
+        if child_pid == writer_pid:
+            print(f"The writer {child_pid=} has failed with {exit_code=} by {signal_number=}")
+            writer_pid = None
+            writer_OK = False
+            for pid in mypids:
+                os.kill(pid, signal.SIGTERM)
+            continue
+
         mypids.remove(child_pid)
         print(f"{child_pid=} has completed with {exit_code=} by {signal_number=}")
 
+    if writer_pid:
+        # All the workers are done; tell the writer to finish up.
+        results_queue.put(None)
+        _, status = os.waitpid(writer_pid, 0)
+        exit_code, signal_number = divmod(status, 256)
+        print(f"The writer {writer_pid=} has completed with {exit_code=} by {signal_number=}")
+        writer_OK = not status
+
+    stats = collect_stats(len(letter_sets))
+    verbose and print(json.dumps(stats['totals']))
+    if myargs.stats:
+        with open(myargs.stats, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+    if not writer_OK:
+        print(f"The results in {db} are not complete.")
+        return os.EX_IOERR
     return os.EX_OK
 
 
-def build_dict(filename:str) -> int:
+def bee_words(text:str) -> list:
     """
-    Take any file of words that is presumably a 'dictionary'
-    of some whitespace delimited collection of words. Apply 
-    the NYTimes rules of the game, and write the file with 
-    the suffix .bee in $PWD.
+    Apply the NYTimes rules of the game to the whitespace delimited
+    tokens in text, and return the distinct words that pass. This
+    is the part of build_dict() that runs in the worker processes.
+
+    NYTimes has these rules for Spelling Bee rules.
+      4+ letters
+      no s
+      just letters.
+      no proper nouns.
+      no more than 7 unique letters per word.
     """
-
-    ###
-    # We are not going for efficiency here. This is only executed
-    # once, and after this step the new file is the one used, and
-    # it assumed to be correct.
-    #
-    # NYTimes has these rules for Spelling Bee rules.
-    #   4+ letters
-    #   no s
-    #   just letters.
-    #   no proper nouns.
-    #   no more than 7 unique letters per word.
-    ###
-    words = tuple(word for word in read_whitespace_file(filename) 
+    return list(set(word for word in text.split()
         if 's' not in word and
         len(word) > 3 and
         word.islower() and
         word.isalpha() and
-        len(set(word)) < 8)
+        len(set(word)) < 8))
 
-    print(f"{len(words)=}")
 
-    with open(f"{os.path.basename(filename)}.bee", 'w') as f:
-        with contextlib.redirect_stdout(f):
-            for word in words:
-                print(word)
+def build_dict(filename:str, num_cpus:int=1, 
+    chunk_size:int=1 << 24, num_buckets:int=64) -> int:
+    """
+    Take any file of words that is presumably a 'dictionary'
+    of some whitespace delimited collection of words. Apply 
+    the NYTimes rules of the game, and write the file with 
+    the suffix .bee in $PWD, along with its compiled form, 
+    .bee.idx.
+
+    The file is read chunk_size characters at a time, and the 
+    chunks are filtered by num_cpus processes. Duplicates are 
+    removed by spreading the words over num_buckets temporary 
+    files by their CRC, and then removing the duplicates one
+    bucket at a time, so the memory used depends on the size 
+    of the largest bucket rather than the size of the input.
+    Each bucket is written to the .bee file in sorted order, so
+    the same input always gives the same files. Each bucket is 
+    also left sorted by letter mask, and the index is written 
+    from a merge of the buckets.
+    """
+    bee_name = f"{os.path.basename(filename)}.bee"
+
+    with tempfile.TemporaryDirectory() as bucket_dir:
+        buckets = [open(os.path.join(bucket_dir, str(i)), 'w+') for i in range(num_buckets)]
+
+        with multiprocessing.Pool(num_cpus) as pool:
+            ###
+            # Keep no more than two chunks per process in flight, so 
+            # that the file is not read faster than it is filtered.
+            ###
+            pending = collections.deque()
+            chunks = read_whitespace_chunks(filename, chunk_size)
+            while True:
+                for chunk in chunks:
+                    pending.append(pool.apply_async(bee_words, (chunk,)))
+                    if len(pending) >= 2 * num_cpus: break
+                if not pending: break
+                for word in pending.popleft().get():
+                    buckets[zlib.crc32(word.encode('utf-8')) % num_buckets].write(f"{word}\n")
+
+        n = 0
+        with open(bee_name, 'w') as f:
+            for bucket in buckets:
+                bucket.seek(0)
+                words = sorted(set(bucket.read().split()))
+                n += len(words)
+                f.writelines(f"{word}\n" for word in words)
+
+                bucket.seek(0)
+                bucket.truncate()
+                bucket.writelines(f"{word}\n" for word in sorted(words, key=letter_mask))
+                bucket.seek(0)
+
+        print(f"{n=}")
+        by_mask = heapq.merge(*((word.rstrip('\n') for word in bucket) for bucket in buckets),
+            key=letter_mask)
+        beeidx.write_sorted_index(n, ((letter_mask(word), word) for word in by_mask),
+            f"{bee_name}.idx", bee_name)
+        for bucket in buckets:
+            bucket.close()
+
+    return n
+
+
+def build_masks(words:Iterable) -> array:
+    """
+    Build the letter mask index for a dictionary. The masks are
+    in the same order as the words, so masks[i] belongs to words[i].
+    This is done once, when the dictionary is loaded.
+    """
+    return array('I', (letter_mask(word) for word in words))
 
-    return len(words)
 
 def build_regex(required_letter:str, other_letters:str) -> re.Pattern:
     """
@@ -174,10 +518,579 @@ def build_regex(required_letter:str, other_letters:str) -> re.Pattern:
     all_letters = required_letter + other_letters
     return re.compile(f"[{other_letters}]*{required_letter}[{all_letters}]*")
 
-def read_whitespace_file(filename:str) -> tuple:
+
+def build_trie(words:Iterable) -> dict:
     """
-    This is a generator that returns the whitespace delimited tokens 
-    in a text file, one token at a time.
+    Build the trie of the words.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = word
+    return trie
+
+
+def collect_stats(num_letter_sets:int) -> dict:
+    """
+    Gather the run_stats that the children sent, and add them up.
+    """
+    global stats_queue
+    global start_time
+
+    processes = []
+    while not stats_queue.empty():
+        processes.append(stats_queue.get())
+
+    workers = [_ for _ in processes if _['role'] == 'worker']
+    writers = [_ for _ in processes if _['role'] == 'writer']
+    totals = collections.defaultdict(int)
+    for process in workers + writers:
+        for k, v in process.items():
+            if k.endswith('_seconds') or k in ('letter_sets', 'pangrams', 
+                'rows_sent', 'rows_written', 'transactions'):
+                totals[k] += v
+    totals['peak_rss_kb'] = max((_['peak_rss_kb'] for _ in processes), default=0)
+    totals['elapsed_seconds'] = time.time() - start_time
+
+    return {"letter_sets":num_letter_sets, "totals":totals, 
+        "workers":workers, "writer":writers[0] if writers else None}
+
+
+def create_schema() -> None:
+    """
+    Create whatever tables and indexes are missing, and add the
+    aggregate columns to answer tables from older versions.
+    """
+    global db
+    global SCHEMA
+    global INDEXES
+
+    for statement in SCHEMA:
+        db.execute_SQL(statement)
+    upgrade_schema()
+    for statement in INDEXES:
+        db.execute_SQL(statement)
+    db.commit()
+
+
+def decode_hints(text:str) -> dict:
+    """
+    The inverse of encode_hints().
+    """
+    grid, starts = text.split(';')
+    return {"grid":{c:{n:int(k) for n, k in re.findall(r'(\d+):(\d+)', pairs)}
+            for c, pairs in re.findall(r'([a-z])([\d:,]+)', grid)},
+        "starts":{k:int(n) for k, n in re.findall(r'([a-z]{2})(\d+)', starts)}}
+
+
+def decode_word_ids(blob:bytes) -> list:
+    """
+    The inverse of encode_word_ids().
+    """
+    ids = []
+    previous = value = shift = 0
+    for byte in blob:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += value
+            ids.append(previous)
+            value = shift = 0
+    return ids
+
+
+def dictionary_checksum(filename:str) -> Union[bytes, None]:
+    """
+    The SHA-256 of a .bee file, or, for a compiled index, of the 
+    .bee file it was made from. None if it cannot be read.
+    """
+    try:
+        if not filename.endswith('.idx'): return beeidx.checksum(filename)
+        index = beeidx.BeeIndex(filename)
+        checksum = index.source_checksum
+        index.close()
+        return checksum
+    except (OSError, ValueError) as e:
+        return None
+
+
+def encode_hints(hints:dict) -> str:
+    """
+    The hint grid from hint_grid() as compact text, about a quarter
+    the size of its JSON. Each first letter is followed by its 
+    length:count pairs, then comes ';', and then each pair of first
+    two letters followed by its count:
+
+        d5:1,6:2e4:1,5:2;do3ed2eg1
+    """
+    grid = "".join(c + ",".join(f"{n}:{k}" for n, k in lengths.items())
+        for c, lengths in hints['grid'].items())
+    starts = "".join(f"{k}{n}" for k, n in hints['starts'].items())
+    return f"{grid};{starts}"
+
+
+def encode_word_ids(ids:Iterable) -> bytes:
+    """
+    Sort the ids, and write the differences between successive
+    ids as varints: seven bits per byte, low bits first, with the 
+    high bit set on every byte but the last. Most differences fit 
+    in one or two bytes.
+    """
+    blob = bytearray()
+    previous = 0
+    for i in sorted(ids):
+        delta, previous = i - previous, i
+        while delta >= 0x80:
+            blob.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        blob.append(delta)
+    return bytes(blob)
+
+
+def flush_results(force:bool=False, in_bulk_load:bool=False) -> bool:
+    """
+    Write the buffered rows if there are enough of them, or if it
+    has been long enough, or if force is True. All the rows go in
+    one transaction, after which the WAL is checkpointed. If 
+    in_bulk_load, the transaction is the one db.bulk_load() began,
+    and another is begun after the commit.
+    """
+    global db
+    global SQL
+    global PANGRAM_SQL
+    global mypid
+    global mylock
+    global batch_size
+    global flush_interval
+    global pending_answers
+    global pending_pangrams
+    global last_flush
+
+    global run_stats
+
+    if not (force or len(pending_answers) >= batch_size or
+        time.time() - last_flush >= flush_interval): return True
+    if not (pending_answers or pending_pangrams): return True
+
+    try:
+        mylock.acquire()
+        start = time.perf_counter()
+        in_bulk_load or db.execute_SQL("BEGIN IMMEDIATE TRANSACTION")
+        run_stats['db_wait_seconds'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        db.executemany_SQL(SQL, pending_answers)
+        db.executemany_SQL(PANGRAM_SQL, pending_pangrams)
+        run_stats['write_seconds'] += time.perf_counter() - start
+        run_stats['rows_written'] += len(pending_answers)
+
+        start = time.perf_counter()
+        robust_commit()
+        db.execute_SQL("pragma wal_checkpoint(PASSIVE)")
+        in_bulk_load and db.execute_SQL("BEGIN IMMEDIATE TRANSACTION")
+        run_stats['commit_seconds'] += time.perf_counter() - start
+        run_stats['transactions'] += 1
+
+    except Exception as e:
+        print(f"{mypid}:Exception writing to db. {e=} {len(pending_answers)=}")
+        return False
+
+    finally:
+        mylock.release()
+        pending_answers = []
+        pending_pangrams = []
+        last_flush = time.time()
+
+    return True
+
+
+def group_by_mask(words:Sequence, masks:Sequence) -> dict:
+    """
+    Group the dictionary by letter set. The positions of all the
+    words with the same distinct letters land in the same group,
+    so a puzzle is solved by looking up the subsets of its letters 
+    rather than by examining every word. A compiled dictionary is
+    already sorted by mask, and it can do this for us.
+    """
+    if isinstance(words, beeidx.BeeIndex):
+        return words.groups()
+
+    groups = {}
+    for i, mask in enumerate(masks):
+        groups.setdefault(mask, []).append(i)
+    return groups
+
+
+def hint_grid(answers:Iterable) -> dict:
+    """
+    The NYTimes hints for a puzzle: "grid" is first letter -> 
+    word length -> number of answers, and "starts" is first two
+    letters -> number of answers. The lengths are str so that
+    the dict is the same after a trip through JSON. Everything is
+    sorted, so the grid does not depend on the order of answers.
+    """
+    grid = {}
+    starts = collections.Counter()
+    for word in answers:
+        lengths = grid.setdefault(word[0], {})
+        lengths[str(len(word))] = lengths.get(str(len(word)), 0) + 1
+        starts[word[:2]] += 1
+
+    return {"grid":{c:{n:grid[c][n] for n in sorted(grid[c], key=int)} for c in sorted(grid)}, 
+        "starts":{k:starts[k] for k in sorted(starts)}}
+
+
+def letter_mask(word:str) -> int:
+    """
+    Return the 26-bit mask of the letters in word.
+    """
+    mask = 0
+    for c in set(word):
+        mask |= letter_bits.get(c, foreign_bit)
+    return mask
+
+
+def load_dictionary(filename:str) -> tuple:
+    """
+    Return the words and their masks. If there is a compiled 
+    index (filename.idx), and it is current, it is mapped into
+    memory. Otherwise, we read the text of the .bee file. Either 
+    way, dict_checksum is set for record_dictionary().
+    """
+    global verbose
+    global dict_checksum
+
+    idx_name = filename if filename.endswith('.idx') else f"{filename}.idx"
+    if os.path.isfile(idx_name):
+        try:
+            index = beeidx.BeeIndex(idx_name)
+        except ValueError as e:
+            print(e)
+        else:
+            if idx_name == filename or index.matches(filename):
+                verbose and print(f"Using compiled dictionary {idx_name}")
+                dict_checksum = index.source_checksum
+                return index, index.masks
+            verbose and print(f"{idx_name} is out of date; reading {filename}")
+            index.close()
+
+    with open(filename) as f:
+        words = tuple(f.read().split())
+    dict_checksum = beeidx.checksum(filename)
+    return words, build_masks(words)
+
+
+def load_word_ids(words:Sequence) -> dict:
+    """
+    Make sure every word is in the words table, and read back
+    the ids. Words already in the table keep their ids.
+    """
+    global db
+    global WORD_SQL
+    global word_ids
+
+    db.executemany_SQL(WORD_SQL, ((word,) for word in sorted(words)), transaction=True)
+    word_ids = {word:i for i, word in db.cursor.execute("SELECT id, word FROM words")}
+    return word_ids
+
+
+def lookup_answers(puzzle:str, middle_letter:str, 
+    source:sqlitedb.SQLiteDB=None) -> Union[list, None]:
+    """
+    Check answer_cache, and then the database, for a puzzle that
+    has already been solved. Returns None if it has not been. 
+    Threads must supply source, a SQLiteDB from which to borrow
+    a connection; otherwise db is used.
+    """
+    global answer_cache
+    global answer_cache_lock
+
+    key = (puzzle, middle_letter)
+    with answer_cache_lock:
+        if key in answer_cache:
+            answer_cache.move_to_end(key)
+            return answer_cache[key]
+
+    try:
+        if source is None:
+            answers = read_answers(puzzle, middle_letter)
+        else:
+            with source.connection() as conn:
+                answers = read_answers(puzzle, middle_letter, conn)
+    except Exception as e:
+        # Most likely, the table is not there.
+        answers = None
+
+    if answers is not None:
+        remember_answers(puzzle, middle_letter, answers)
+    return answers
+
+
+def mask_letters(mask:int) -> str:
+    """
+    The inverse of letter_mask(): the letters in mask, sorted.
+    """
+    return "".join(c for c, bit in letter_bits.items() if mask & bit)
+
+
+def mask_solve(required_letter:str, other_letters:str, 
+    words:Sequence, masks:Sequence) -> tuple:
+    """
+    Solve one puzzle with the letter mask index. A word is an 
+    answer if it uses no letter outside the puzzle, and it
+    contains the required letter.
+    """
+    outside = ~letter_mask(required_letter + other_letters)
+    required = letter_bits[required_letter]
+    return tuple(words[i] for i, mask in enumerate(masks) 
+        if not mask & outside and mask & required)
+
+
+def merge_shards(dirname:str, words:Sequence, num_cpus:int) -> int:
+    """
+    Load the shards written by a --shards batch run into the 
+    database. num_cpus processes read and decode the shards, and
+    build the rows, one shard at a time each; this process writes
+    them, all in one bulk load. The rows already in the database 
+    for the puzzles in a shard are replaced, so merging the same 
+    shards again changes nothing. The dictionary must be the one 
+    that the shards were made from.
+    """
+    global db
+    global SQL
+    global PANGRAM_SQL
+    global INDEXES
+    global schema
+
+    shards = sorted(glob.glob(os.path.join(dirname, "shard.*.jsonl.gz")))
+    if not shards:
+        print(f"There are no shards in {dirname}.")
+        return os.EX_NOINPUT
+
+    record_dictionary(words)
+    schema == 'compact' and load_word_ids(words)
+
+    ###
+    # The indexes are dropped for the bulk load, so the old rows are
+    # found with one pass per shard, through a table of its puzzles.
+    ###
+    table = 'compact_answers' if schema == 'compact' else 'answers'
+    num_rows = 0
+    damaged = []
+    with multiprocessing.Pool(num_cpus) as pool, db.bulk_load(INDEXES):
+        db.execute_SQL("CREATE TEMP TABLE IF NOT EXISTS merged_puzzles (puzzle TEXT PRIMARY KEY)")
+        for filename, answers, pangrams in pool.imap_unordered(read_shard, shards):
+            if answers is None:
+                damaged.append(filename)
+                continue
+            db.execute_SQL("DELETE FROM merged_puzzles")
+            db.executemany_SQL("INSERT OR IGNORE INTO merged_puzzles (puzzle) VALUES (?)",
+                ((row[1],) for row in answers))
+            db.execute_SQL(f"DELETE FROM {table} WHERE puzzle IN (SELECT puzzle FROM merged_puzzles)")
+            db.execute_SQL("DELETE FROM pangrams WHERE puzzle IN (SELECT puzzle FROM merged_puzzles)")
+            db.executemany_SQL(SQL, answers)
+            db.executemany_SQL(PANGRAM_SQL, pangrams)
+            num_rows += len(answers)
+
+    verbose and print(f"{num_rows} answer rows loaded from {len(shards)-len(damaged)} shards.")
+    if damaged:
+        print(f"These shards are damaged, and were not loaded: {damaged}")
+        return os.EX_DATAERR
+    return os.EX_OK
+
+
+def next_chunk(letter_sets:tuple) -> tuple:
+    """
+    Claim the next chunk_size letter sets. When they are all 
+    gone, the result is empty.
+    """
+    global chunk_counter
+    global chunk_size
+
+    with chunk_counter.get_lock():
+        lower = chunk_counter.value
+        chunk_counter.value = lower + chunk_size
+    return letter_sets[lower:lower + chunk_size]
+
+
+def numpy_solve(required_letter:str, other_letters:str, 
+    words:Sequence, masks:Sequence=None) -> tuple:
+    """
+    Solve one puzzle with the numpy engine.
+    """
+    return numpy_solve_set(required_letter + other_letters, words)[required_letter]
+
+
+def numpy_solve_set(letters:str, words:Sequence) -> dict:
+    """
+    Find the words that fit the letters with one vectorized pass
+    over numpy_masks, and then test the hits against all the 
+    required letters at once: column j of has_letter is True
+    where the word contains letters[j].
+    """
+    global numpy_masks
+
+    letters = "".join(set(letters))
+    outside = numpy.uint32(~letter_mask(letters) & 0xFFFFFFFF)
+    hits = numpy.flatnonzero((numpy_masks & outside) == 0)
+
+    required = numpy.array([letter_bits[_] for _ in letters], dtype=numpy.uint32)
+    has_letter = (numpy_masks[hits][:, None] & required[None, :]) != 0
+
+    return {required_letter:tuple(words[i] for i in hits[has_letter[:, j]].tolist())
+        for j, required_letter in enumerate(letters)}
+
+
+def pangram_letter_sets(words:Sequence, masks:Sequence) -> dict:
+    """
+    Collapse the pangrams in the dictionary into their distinct 
+    letter sets. Returns a dict of sorted letters -> list of the
+    pangrams made from exactly those letters. A word with a letter
+    outside a-z is never a pangram.
+    """
+    letter_sets = {}
+    for i, mask in enumerate(masks):
+        if not mask & foreign_bit and bin(mask).count('1') == 7:
+            letter_sets.setdefault(mask_letters(mask), []).append(words[i])
+    return letter_sets
+
+
+def prepare_engine(words:Sequence, masks:Sequence) -> bool:
+    """
+    Build whatever the selected engine needs beyond the words 
+    and their masks. Returns False if the engine cannot be used.
+    """
+    global engine
+    global mask_groups
+    global numpy_masks
+    global word_trie
+    global we_have_numpy
+
+    if engine == 'subset':
+        mask_groups = group_by_mask(words, masks)
+
+    elif engine == 'trie':
+        word_trie = build_trie(words)
+
+    elif engine == 'numpy':
+        if not we_have_numpy:
+            print("The numpy engine requires numpy, and it is not installed.")
+            return False
+        numpy_masks = numpy.frombuffer(masks, dtype=numpy.uint32)
+
+    return True
+
+
+def puzzle_stats(answers:Iterable) -> tuple:
+    """
+    Score a puzzle by the NYTimes rules: one point for a four
+    letter word, a point per letter for longer words, and seven
+    more for a pangram. Returns (word_count, score, pangram_count,
+    genius).
+    """
+    word_count = score = pangram_count = 0
+    for word in answers:
+        word_count += 1
+        score += 1 if len(word) == 4 else len(word)
+        if len(set(word)) == 7:
+            pangram_count += 1
+            score += 7
+
+    return (word_count, score, pangram_count, rank_thresholds(score)['Genius'])
+
+
+def rank_thresholds(score:int) -> dict:
+    """
+    The minimum score for each rank in a puzzle whose answers are 
+    worth score points.
+    """
+    global RANKS
+    return {rank:int(score * fraction + 0.5) for rank, fraction in RANKS}
+
+
+def read_answers(puzzle:str, middle_letter:str, 
+    conn:sqlite3.Connection=None) -> Union[list, None]:
+    """
+    Return the sorted answers to one puzzle from the database, from
+    whichever schema is in use. puzzle is the sorted letters. If
+    the puzzle is not in the database, return None. A thread must
+    supply its own conn, from db.connection().
+    """
+    global db
+    global schema
+
+    conn = conn or db.cursor
+    if schema == 'text':
+        row = conn.execute(
+            "SELECT matches FROM answers WHERE puzzle = ? AND middle_letter = ?",
+            (puzzle, middle_letter)).fetchone()
+        return sorted(row[0].split()) if row else None
+
+    row = conn.execute(
+        "SELECT matches FROM compact_answers WHERE puzzle = ? AND middle_letter = ?",
+        (puzzle, middle_letter)).fetchone()
+    if not row: return None
+
+    ids = decode_word_ids(row[0])
+    return sorted(word for _, word in conn.execute(
+        f"SELECT id, word FROM words WHERE id IN ({','.join('?'*len(ids))})", ids))
+
+
+def read_hints(puzzle:str, middle_letter:str) -> Union[dict, None]:
+    """
+    Return the hint grid for one puzzle from the database, or 
+    None if the puzzle is not there, or was written before the
+    hints were.
+    """
+    global db
+    global schema
+
+    table = 'compact_answers' if schema == 'compact' else 'answers'
+    row = db.cursor.execute(
+        f"SELECT hints FROM {table} WHERE puzzle = ? AND middle_letter = ?",
+        (puzzle, middle_letter)).fetchone()
+    return decode_hints(row[0]) if row and row[0] else None
+
+
+def read_shard(filename:str) -> tuple:
+    """
+    Decode one shard into the rows for SQL and PANGRAM_SQL, and
+    return (filename, answer rows, pangram rows). If the shard is 
+    damaged, e.g., its worker was killed while writing it, the rows
+    are None. The pid column is the pid of the worker that wrote the
+    shard. The pangrams are not in the shard, because they are the 
+    answers that use all the letters of the puzzle.
+    """
+    global mypid
+
+    mypid = int(os.path.basename(filename).split('.')[1])
+    answers = []
+    pangrams = []
+    try:
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            for line in f:
+                required_letter, puzzle, matches = json.loads(line)
+                answers.append(answer_row(required_letter, puzzle, matches))
+                if required_letter == puzzle[0]:
+                    mask = letter_mask(puzzle)
+                    pangrams.extend((puzzle, word) for word in matches 
+                        if letter_mask(word) == mask)
+
+    except (OSError, EOFError, ValueError) as e:
+        print(f"{filename} is damaged. {e}")
+        return filename, None, None
+
+    return filename, answers, pangrams
+
+
+def read_whitespace_chunks(filename:str, chunk_size:int=1 << 24) -> Iterable:
+    """
+    This is a generator that returns a text file about chunk_size
+    characters at a time. Each chunk ends at whitespace, so no 
+    token is split between two chunks.
     """
     if not filename: return tuple()
 
@@ -185,10 +1098,150 @@ def read_whitespace_file(filename:str) -> tuple:
         sys.stderr.write(f"{filename} cannot be found.")
         return os.EX_NOINPUT
 
-    f = open(filename)
-    yield from (" ".join(f.read().split('\n'))).split()
+    carry = ''
+    with open(filename) as f:
+        for block in iter(lambda: f.read(chunk_size), ''):
+            block = carry + block
+            cut = max(block.rfind(c) for c in ' \t\n\r\f\v') + 1
+            # A token longer than the chunk is carried whole.
+            carry = block[cut:]
+            if cut: yield block[:cut]
+    if carry: yield carry
+
+
+def read_whitespace_file(filename:str) -> tuple:
+    """
+    This is a generator that returns the whitespace delimited tokens 
+    in a text file, one token at a time.
+    """
+    for chunk in read_whitespace_chunks(filename):
+        yield from chunk.split()
     
 
+def record_dictionary(words:Sequence) -> int:
+    """
+    Replace the contents of the dictionary table with words, so
+    that a later --update can tell what has changed, and record the
+    checksum of the file they came from, so that a lookup can tell
+    that the answers are for the dictionary it was given.
+    """
+    global db
+    global dict_checksum
+
+    db.execute_SQL("DELETE FROM dictionary_source")
+    db.execute_SQL("INSERT INTO dictionary_source (checksum) VALUES (?)", dict_checksum)
+    db.execute_SQL("DELETE FROM dictionary")
+    return db.executemany_SQL("INSERT OR IGNORE INTO dictionary (word) VALUES (?)",
+        ((word,) for word in words), transaction=True)
+
+
+def recorded_checksum(source:sqlitedb.SQLiteDB=None) -> Union[bytes, None]:
+    """
+    The checksum that record_dictionary() saved in source (default:
+    db), or None if there is none, e.g., in a database made before 
+    it was recorded.
+    """
+    global db
+
+    source = source or db
+    try:
+        row = source.cursor.execute("SELECT checksum FROM dictionary_source").fetchone()
+    except sqlite3.Error as e:
+        return None
+    return row[0] if row else None
+
+
+def regex_solve(required_letter:str, other_letters:str, 
+    words:Sequence, masks:Sequence=None) -> tuple:
+    """
+    Solve one puzzle by matching the regex from build_regex against
+    every word. This is the reference engine; it is much slower than
+    mask_solve, but it is useful for checking results.
+    """
+    c_expression = build_regex(required_letter, other_letters)
+    return tuple(_ for _ in words if c_expression.fullmatch(_))
+
+
+def remember_answers(puzzle:str, middle_letter:str, answers:list) -> None:
+    """
+    Put the answers in answer_cache, and drop the least recently 
+    used puzzle if there are too many.
+    """
+    global answer_cache
+    global answer_cache_size
+    global answer_cache_lock
+
+    with answer_cache_lock:
+        answer_cache[(puzzle, middle_letter)] = answers
+        answer_cache.move_to_end((puzzle, middle_letter))
+        while len(answer_cache) > answer_cache_size:
+            answer_cache.popitem(last=False)
+
+
+def report_progress(num_letter_sets:int) -> None:
+    """
+    Write a line to stderr with how much is done, and how long
+    the rest should take at the rate so far.
+    """
+    global done_counter
+    global start_time
+
+    done = done_counter.value
+    elapsed = time.time() - start_time
+    rate = done / elapsed if elapsed else 0.0
+    eta = (num_letter_sets - done) / rate if rate else float('inf')
+    sys.stderr.write(f"{done}/{num_letter_sets} letter sets "
+        f"({100 * done / max(num_letter_sets, 1):.1f}%), {rate:.1f}/s, ETA {eta:.0f}s\n")
+
+
+def report_save(status:int, remaining:int, total:int) -> None:
+    """
+    The progress function for saving an in-memory database; it is
+    called after each step of the backup.
+    """
+    sys.stderr.write(f"Saved {total-remaining}/{total} pages\n")
+
+
+def resume_letter_sets(letter_sets:dict, words:Sequence) -> Union[dict, None]:
+    """
+    If the database already has answers, e.g., from a batch run that
+    was killed, or from its restored checkpoint, return the letter 
+    sets that still need to be solved. A letter set is done if all 
+    its puzzles and all its pangrams are in the database. The rows 
+    of the ones that were partly written are deleted, and they are 
+    solved again. Returns None if the answers were made from some
+    other dictionary than words.
+    """
+    global db
+    global schema
+
+    table = 'compact_answers' if schema == 'compact' else 'answers'
+    if not db.cursor.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+        return letter_sets
+
+    old_words = set(word for word, in db.cursor.execute("SELECT word FROM dictionary"))
+    if old_words != set(words): return None
+
+    answer_counts = dict(db.cursor.execute(
+        f"SELECT puzzle, COUNT(*) FROM {table} GROUP BY puzzle"))
+    pangram_counts = dict(db.cursor.execute(
+        "SELECT puzzle, COUNT(*) FROM pangrams GROUP BY puzzle"))
+
+    done = {puzzle for puzzle, pangrams in letter_sets.items()
+        if answer_counts.get(puzzle) == len(puzzle) and 
+            pangram_counts.get(puzzle) == len(pangrams)}
+    partial = (set(answer_counts) | set(pangram_counts)) - done
+
+    db.execute_SQL("BEGIN IMMEDIATE TRANSACTION")
+    db.executemany_SQL(f"DELETE FROM {table} WHERE puzzle = ?", ((_,) for _ in partial))
+    db.executemany_SQL("DELETE FROM pangrams WHERE puzzle = ?", ((_,) for _ in partial))
+    db.commit()
+
+    print(f"Resuming: {len(done)} letter sets are already in {db}; "
+        f"{len(partial)} were incomplete.")
+    return {puzzle:pangrams for puzzle, pangrams in letter_sets.items() if puzzle not in done}
+
+
 def robust_commit() -> None:
     global db
     global mylock
@@ -203,6 +1256,100 @@ def robust_commit() -> None:
 
         
 
+def send_results(force:bool=False) -> bool:
+    """
+    Send the buffered rows to the writer if there are send_size
+    of them, or if force is True.
+    """
+    global results_queue
+    global send_size
+    global pending_answers
+    global pending_pangrams
+    global run_stats
+
+    if not (force or len(pending_answers) >= send_size): return True
+    if not (pending_answers or pending_pangrams): return True
+
+    start = time.perf_counter()
+    results_queue.put((pending_answers, pending_pangrams))
+    run_stats['send_seconds'] += time.perf_counter() - start
+    run_stats['rows_sent'] += len(pending_answers)
+    pending_answers = []
+    pending_pangrams = []
+    return True
+
+
+def send_stats(role:str) -> None:
+    """
+    Send this process's run_stats to the parent.
+    """
+    global mypid
+    global run_stats
+    global stats_queue
+
+    run_stats['role'] = role
+    run_stats['pid'] = mypid
+    # On Linux, ru_maxrss is in kilobytes.
+    run_stats['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stats_queue.put(dict(run_stats))
+
+
+def shared_answers(puzzle:str, middle_letter:str, minimum:int) -> list:
+    """
+    Find the puzzles in the compact schema that have at least 
+    minimum answers in common with this one. Returns a list of 
+    (puzzle, middle_letter, number in common), most first. The
+    comparison is done on sets of ids, never on the words.
+    """
+    global db
+
+    row = db.cursor.execute(
+        "SELECT matches FROM compact_answers WHERE puzzle = ? AND middle_letter = ?",
+        (puzzle, middle_letter)).fetchone()
+    if not row: return []
+    these = set(decode_word_ids(row[0]))
+
+    shared = []
+    for other, other_letter, blob in db.iter_SQL(
+        "SELECT puzzle, middle_letter, matches FROM compact_answers"):
+        if (other, other_letter) == (puzzle, middle_letter): continue
+        n = len(these.intersection(decode_word_ids(blob)))
+        if n >= minimum:
+            shared.append((other, other_letter, n))
+
+    return sorted(shared, key=lambda _: -_[2])
+
+
+def solve_letter_set(letters:str, words:Sequence, masks:Sequence) -> dict:
+    """
+    Solve all the puzzles that can be made from one set of letters,
+    i.e., the same letters with each one in turn as the required
+    letter. Returns a dict of required_letter -> tuple of words.
+    """
+    global engine
+
+    if engine == 'subset':
+        return subset_solve_set(letters, words)
+
+    if engine == 'numpy':
+        return numpy_solve_set(letters, words)
+
+    if engine == 'trie':
+        return trie_solve_set(letters)
+
+    if engine == 'regex':
+        expression = re.compile(f"[{letters}]*")
+        all_matches = tuple(_ for _ in words if expression.fullmatch(_))
+        return {required_letter:tuple(word for word in all_matches if required_letter in word)
+            for required_letter in letters}
+
+    outside = ~letter_mask(letters)
+    all_matches = tuple((words[i], mask) for i, mask in enumerate(masks) if not mask & outside)
+    return {required_letter:tuple(word for word, mask in all_matches 
+                if mask & letter_bits[required_letter])
+        for required_letter in letters}
+
+
 def splitter(group:Iterable, num_chunks:int) -> Iterable:
     """
     Generator to divide a collection into num_chunks pieces.
@@ -241,42 +1388,388 @@ def splitter(group:Iterable, num_chunks:int) -> Iterable:
             yield group[lower:upper]
 
 
-def write_results(letter:str, pangram:str, results:tuple) -> bool:
+def stop_shard(signum:int, frame:object) -> None:
+    """
+    The SIGTERM handler of a worker that writes a shard.
+    """
+    global shard_stopping
+    shard_stopping = True
+
+
+def store_answers(puzzle:str, middle_letter:str, answers:list) -> bool:
     """
-    Record a result in the database.
+    Write the answers to one puzzle to the database, in whichever
+    schema is in use, so that the next lookup will find them.
     """
     global db
     global SQL
+    global WORD_SQL
     global mypid
-    global mylock
-    results = " ".join(results)
+    global schema
+    global word_ids
+
     try:
-        mylock.acquire()
-        db.execute_SQL(SQL, letter, pangram, results, mypid, transaction=True)
+        if schema == 'compact':
+            db.executemany_SQL(WORD_SQL, ((word,) for word in answers))
+            word_ids = word_ids or {}
+            word_ids.update(db.cursor.execute(
+                f"SELECT word, id FROM words WHERE word IN ({','.join('?'*len(answers))})", answers))
+        db.execute_SQL(SQL, *answer_row(middle_letter, puzzle, answers), transaction=True)
 
     except Exception as e:
-        print(f"{mypid}:Exception writing to db. {e=} {letter=} {pangram=} {results=}")
+        print(f"{mypid}:Exception writing to db. {e=} {puzzle=} {middle_letter=}")
         return False
 
-    finally:
-        mylock.release()
-        
+    remember_answers(puzzle, middle_letter, answers)
     return True
 
 
+def submasks(mask:int) -> Iterable:
+    """
+    Generator of the non-empty sub-masks of mask, largest first.
+    A 7-letter puzzle has 127 of them.
+    """
+    sub = mask
+    while sub:
+        yield sub
+        sub = (sub - 1) & mask
+
+
+def subset_solve(required_letter:str, other_letters:str, 
+    words:Sequence=None, masks:Sequence=None, groups:dict=None) -> tuple:
+    """
+    Solve one puzzle with the subset engine. Only the sub-masks 
+    that contain the required letter are looked up, 64 of them for
+    a 7-letter puzzle. The masks argument is only for symmetry with
+    the other solvers; the work is done with groups, which defaults
+    to mask_groups.
+    """
+    global mask_groups
+
+    groups = mask_groups if groups is None else groups
+    required = letter_bits[required_letter]
+    rest = letter_mask(other_letters) & ~required
+
+    found = []
+    sub = rest
+    while True:
+        hits = groups.get(sub | required)
+        if hits: found.extend(hits)
+        if not sub: break
+        sub = (sub - 1) & rest
+
+    return tuple(words[i] for i in found)
+
+
+def subset_solve_set(letters:str, words:Sequence, groups:dict=None) -> dict:
+    """
+    Look up every sub-mask of the letters in the groups, and
+    divide the hits according to which letters each sub-mask
+    contains. groups defaults to mask_groups, but a caller with 
+    more than one dictionary can supply the groups that belong 
+    to words.
+    """
+    global mask_groups
+
+    groups = mask_groups if groups is None else groups
+    letters = "".join(set(letters))
+    results = {required_letter:[] for required_letter in letters}
+    for sub in submasks(letter_mask(letters)):
+        hits = groups.get(sub)
+        if not hits: continue
+        for required_letter in letters:
+            if sub & letter_bits[required_letter]:
+                results[required_letter].extend(hits)
+
+    return {required_letter:tuple(words[i] for i in v) 
+        for required_letter, v in results.items()}
+
+
+def top_puzzles(limit:int=20, min_words:int=0, max_words:int=sys.maxsize) -> list:
+    """
+    The highest scoring puzzles with between min_words and max_words 
+    answers, as a list of (puzzle, middle_letter, word_count, score, 
+    pangram_count, genius). The aggregate columns are indexed, so 
+    no answer list is read.
+    """
+    global db
+    global schema
+
+    table = 'compact_answers' if schema == 'compact' else 'answers'
+    return db.cursor.execute(f"""SELECT puzzle, middle_letter, word_count, score, 
+        pangram_count, genius FROM {table} WHERE word_count BETWEEN ? AND ?
+        ORDER BY score DESC LIMIT ?""", (min_words, max_words, limit)).fetchall()
+
+
+def trie_solve(required_letter:str, other_letters:str, 
+    words:Sequence=None, masks:Sequence=None, prefix:str='', trie:dict=None) -> tuple:
+    """
+    Solve one puzzle with the trie, optionally only the answers 
+    that start with prefix. The words and masks arguments are only 
+    for symmetry with the other solvers.
+    """
+    return tuple(word for word in trie_walk(required_letter + other_letters, prefix, trie)
+        if required_letter in word)
+
+
+def trie_solve_set(letters:str, trie:dict=None) -> dict:
+    """
+    Walk the trie once for the letters, and divide the words that
+    are found by the required letters they contain.
+    """
+    letters = "".join(set(letters))
+    results = {required_letter:[] for required_letter in letters}
+    for word in trie_walk(letters, '', trie):
+        for required_letter in letters:
+            if required_letter in word:
+                results[required_letter].append(word)
+
+    return {required_letter:tuple(v) for required_letter, v in results.items()}
+
+
+def trie_walk(letters:str, prefix:str='', trie:dict=None) -> Iterable:
+    """
+    Generator of the words in the trie that start with prefix and
+    use only the letters. Only the branches for those letters are
+    followed, so the cost is in proportion to what is found rather
+    than to the size of the dictionary. trie defaults to word_trie.
+    """
+    global word_trie
+
+    node = word_trie if trie is None else trie
+    for c in prefix:
+        if c not in letters or c not in node: return
+        node = node[c]
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for c, child in node.items():
+            if not c:
+                yield child
+            elif c in letters:
+                stack.append(child)
+
+
+def update_answers(words:Sequence, masks:Sequence) -> int:
+    """
+    Bring the database up to date with a dictionary that has 
+    changed since the batch run that filled it. Only the puzzles
+    whose letters include all the letters of an added or removed
+    word can have changed, and only those are solved again. 
+    Puzzles that no longer have a pangram are removed, and those 
+    that have a new one are added.
+    """
+    global db
+    global SQL
+    global PANGRAM_SQL
+    global schema
+
+    old_words = set(word for word, in db.cursor.execute("SELECT word FROM dictionary"))
+    if not old_words:
+        print(f"{db} does not record the dictionary it was built from. Use --batch.")
+        return os.EX_DATAERR
+
+    new_words = set(words)
+    changed = {letter_mask(word) for word in new_words ^ old_words}
+    verbose and print(f"{len(new_words - old_words)} words added, {len(old_words - new_words)} removed.")
+
+    table = 'compact_answers' if schema == 'compact' else 'answers'
+    letter_sets = pangram_letter_sets(words, masks)
+    puzzles = set(letter_sets).union(puzzle for puzzle, in 
+        db.cursor.execute(f"SELECT DISTINCT puzzle FROM {table}"))
+    affected = sorted(puzzle for puzzle in puzzles 
+        if any(letter_mask(puzzle) & mask == mask for mask in changed))
+
+    schema == 'compact' and load_word_ids(words)
+    answer_rows = []
+    pangram_rows = []
+    for puzzle in affected:
+        if puzzle not in letter_sets: continue
+        for required_letter, matches in solve_letter_set(puzzle, words, masks).items():
+            answer_rows.append(answer_row(required_letter, puzzle, matches))
+        pangram_rows.extend((puzzle, pangram) for pangram in letter_sets[puzzle])
+
+    db.execute_SQL("BEGIN IMMEDIATE TRANSACTION")
+    db.executemany_SQL(f"DELETE FROM {table} WHERE puzzle = ?", ((_,) for _ in affected))
+    db.executemany_SQL("DELETE FROM pangrams WHERE puzzle = ?", ((_,) for _ in affected))
+    db.executemany_SQL(SQL, answer_rows)
+    db.executemany_SQL(PANGRAM_SQL, pangram_rows)
+    db.commit()
+    record_dictionary(words)
+
+    print(f"{len(affected)} puzzles affected; {len(answer_rows)} answer rows written.")
+    return os.EX_OK
+
+
+def upgrade_schema() -> None:
+    """
+    Answer tables written before the aggregates were added lack
+    the columns; add them. The old rows have NULLs, and a new 
+    --batch or --update fills them in.
+    """
+    global db
+    global AGGREGATE_COLUMNS
+
+    for table in ('answers', 'compact_answers'):
+        columns = {row[1] for row in db.cursor.execute(f"pragma table_info({table})")}
+        if not columns: continue
+        for column, datatype in AGGREGATE_COLUMNS:
+            if column not in columns:
+                db.execute_SQL(f"ALTER TABLE {table} ADD COLUMN {column} {datatype}")
+
+
+def write_pangrams(puzzle:str, pangrams:list) -> bool:
+    """
+    Record the pangrams that belong to a letter set.
+    """
+    global pending_pangrams
+    pending_pangrams.extend((puzzle, pangram) for pangram in pangrams)
+    return send_results()
+
+
+def write_queue() -> None:
+    """
+    The body of the writer process. It is the only process that 
+    writes to the database, and it writes what the workers send it
+    until it receives None. The whole run is one bulk load, so the
+    indexes are built once, at the end, but each flush is committed
+    as it is made.
+    """
+    global db
+    global mylock
+    global INDEXES
+    global results_queue
+    global pending_answers
+    global pending_pangrams
+    global run_stats
+
+    exit_code = os.EX_IOERR
+    try:
+        mylock = db.lock
+        db.execute_SQL("pragma wal_autocheckpoint=0")
+
+        # Let kill (SIGTERM), e.g., from SLURM, keep what has been sent.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(os.EX_TEMPFAIL))
+
+        with db.bulk_load(INDEXES):
+            try:
+                while True:
+                    start = time.perf_counter()
+                    item = results_queue.get()
+                    run_stats['idle_seconds'] += time.perf_counter() - start
+                    if item is None: break
+
+                    answers, pangrams = item
+                    pending_answers.extend(answers)
+                    pending_pangrams.extend(pangrams)
+                    if not flush_results(in_bulk_load=True): return
+
+            except (KeyboardInterrupt, SystemExit) as e:
+                # Keep what we have, but the run is not complete.
+                print("The writer was interrupted.")        
+                exit_code = os.EX_TEMPFAIL
+                return
+
+            finally:
+                written = flush_results(force=True, in_bulk_load=True)
+
+            start = time.perf_counter()
+        run_stats['commit_seconds'] += time.perf_counter() - start
+        exit_code = os.EX_OK if written else os.EX_IOERR
+
+    finally:
+        db.close()
+        send_stats('writer')
+        os._exit(exit_code)
+
+
+def write_results(letter:str, pangram:str, results:tuple) -> bool:
+    """
+    Record a result in the database. The row is buffered, and it
+    is sent to the writer by send_results().
+    """
+    global pending_answers
+    pending_answers.append(answer_row(letter, pangram, results))
+    return send_results()
+
+
+def write_shard(letter:str, puzzle:str, results:tuple) -> None:
+    """
+    Append one record to this worker's shard.
+    """
+    global shard
+    global run_stats
+
+    start = time.perf_counter()
+    shard.write(json.dumps((letter, puzzle, results), separators=(',', ':')) + '\n')
+    run_stats['shard_seconds'] += time.perf_counter() - start
+    run_stats['rows_sharded'] += 1
+
+
+# The single puzzle solver for each engine.
+solvers = {'mask':mask_solve, 'numpy':numpy_solve, 'regex':regex_solve, 
+    'subset':subset_solve, 'trie':trie_solve}
+
+
 def bee_main(myargs:argparse.Namespace) -> int:
     """
     Examine the arguments to the program, and do the appropriate
     things. First step is reading the dictionary.
     """
     global verbose
+    global db
+    global engine
+
+    if myargs.build:
+        build_dict(myargs.build, myargs.cpus)
+        return os.EX_OK
 
     ###
-    # Assume the dictionary conforms to the NYTimes rules.
+    # If the puzzle has been solved before, and the answers are
+    # in the database, we need not even load the dictionary.
     ###
-    with open(myargs.dict) as f:
-        words = f.read().split()
+    if not (myargs.batch or myargs.update or myargs.merge):
+        if myargs.middle:
+            r_letter = myargs.middle.lower()
+            letters = myargs.letters.lower()
+        else:
+            r_letter = myargs.letters[0].lower()
+            letters = myargs.letters[1:].lower()
+
+        if len(r_letter) != 1 or not letters:
+            print("You must supply letters and a single middle letter.")
+            return os.EX_USAGE
+        if any(c not in letter_bits for c in r_letter + letters):
+            print("Only the letters a-z may be used.")
+            return os.EX_USAGE
+
+        ###
+        # The answers in the database are only good for the dictionary
+        # that they were made from.
+        ###
+        puzzle = "".join(sorted(set(r_letter + letters)))
+        checksum = dictionary_checksum(myargs.dict)
+        same_dict = db and checksum is not None and recorded_checksum() == checksum
+        answers = lookup_answers(puzzle, r_letter) if same_dict else None
+        if answers is not None:
+            verbose and print(f"Found {puzzle=} {r_letter=} in {db}")
+            print([_ for _ in answers if _.startswith(myargs.prefix)])
+            return os.EX_OK
 
+        ###
+        # Hints come from the trie, which finds the words with a
+        # given prefix without looking at the others.
+        ###
+        if myargs.prefix:
+            engine = 'trie'
+
+    ###
+    # Assume the dictionary conforms to the NYTimes rules.
+    ###
+    words, masks = load_dictionary(myargs.dict)
+    if not prepare_engine(words, masks):
+        return os.EX_UNAVAILABLE
     verbose and print(f"Spelling Bee for {len(words)} words.")
 
     ###
@@ -284,17 +1777,39 @@ def bee_main(myargs:argparse.Namespace) -> int:
     # but all of them. 
     ###
     if myargs.batch: 
-        return beehive(myargs, words)
-
-    if myargs.middle:
-        r_letter = myargs.middle
-        letters = myargs.letters
-    else:
-        r_letter = myargs.letters[0]
-        letters = myargs.letters[1:]
-
-    c_expression = build_regex(r_letter, letters)
-    print(sorted(tuple(_ for _ in words if c_expression.fullmatch(_))))
+        return beehive(myargs, words, masks)
+
+    if myargs.update:
+        if not db:
+            print("--update requires a database.")
+            return os.EX_USAGE
+        return update_answers(words, masks)
+
+    if myargs.merge:
+        if not db:
+            print("--merge requires a database.")
+            return os.EX_USAGE
+        return merge_shards(myargs.merge, words, myargs.cpus)
+
+    if myargs.prefix:
+        print(sorted(trie_solve(r_letter, letters, prefix=myargs.prefix)))
+        return os.EX_OK
+
+    answers = sorted(solvers[engine](r_letter, letters, words, masks))
+    if db and myargs.write_back:
+        ###
+        # A new database takes its dictionary from the first answers
+        # written back to it; others must have been made from this one.
+        ###
+        recorded = recorded_checksum()
+        if recorded is None and not db.cursor.execute("SELECT 1 FROM dictionary LIMIT 1").fetchone():
+            record_dictionary(words)
+            recorded = dict_checksum
+        if recorded == dict_checksum:
+            store_answers(puzzle, r_letter, answers)
+        else:
+            print(f"{db} was made from another dictionary; the answers were not written back.")
+    print(answers)
 
     return os.EX_OK
 
@@ -307,8 +1822,20 @@ if __name__ == '__main__':
     parser.add_argument('-b', '--batch', action='store_true',
         help="find all the pangrams in the dictionary, and test all the circular shifts of each pangram for the spelling bee words.")
 
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+        help=f"number of answer rows each process buffers before writing them in one transaction (default:{batch_size}).")
+
+    parser.add_argument('--build', type=str, default="",
+        help="Apply the rules of the game to this file of words, and write FILE.bee and FILE.bee.idx in $PWD. Uses --cpus processes.")
+
+    parser.add_argument('--checkpoint', type=float, default=0,
+        help="in batch mode, keep the database in memory, and save it to DB.checkpoint every so many seconds (default:0, i.e., on disc).")
+
+    parser.add_argument('--chunk-size', type=int, default=chunk_size,
+        help=f"number of letter sets a process claims at a time in batch mode (default:{chunk_size}).")
+
     parser.add_argument('--cpus', type=int, default=1,
-        help="number of cpus to use in batch mode, assuming one process per core.")
+        help="number of cpus to use in batch mode or with --build, assuming one process per core.")
 
     parser.add_argument('-d', '--dict', type=str, default=default_word_list,
         help="Name of the dictionary file.")
@@ -316,27 +1843,80 @@ if __name__ == '__main__':
     parser.add_argument('--db', type=str, default="",
         help="Name of the database to which to write the results.")
 
+    parser.add_argument('-e', '--engine', type=str, default='subset',
+        choices=('mask', 'numpy', 'regex', 'subset', 'trie'),
+        help="How to solve the puzzles. 'regex' is the slow reference engine.")
+
+    parser.add_argument('--flush-interval', type=float, default=flush_interval,
+        help=f"maximum number of seconds buffered rows wait to be written (default:{flush_interval}).")
+
     parser.add_argument('-l', '--letters', type=str,
         help="Letters to use, either six letters, or seven with the required letter first.")
 
+    parser.add_argument('--merge', type=str, default="",
+        help="Load the shards in this directory into --db, using --cpus processes. Use the same --dict and --schema as the batch run.")
+
     parser.add_argument('-m', '--middle', type=str, 
         help="Middle letter")
 
+    parser.add_argument('-p', '--prefix', type=str, default="",
+        help="In single puzzle mode, only the answers that start with this; a hint.")
+
+    parser.add_argument('--progress', type=float, default=progress_interval,
+        help=f"seconds between progress reports to stderr in batch mode; 0 for none (default:{progress_interval}).")
+
+    parser.add_argument('--schema', type=str, default='text', choices=('text', 'compact'),
+        help="How batch mode stores the answers: space separated words, or delta encoded word ids.")
+
+    parser.add_argument('--shards', type=str, default="",
+        help="In batch mode, have each process write its answers to a compressed file in this directory rather than to --db. See --merge.")
+
+    parser.add_argument('--stats', type=str, default="",
+        help="Name of a file for the JSON report of the timings and counts of each process in batch mode.")
+
+    parser.add_argument('-u', '--update', action='store_true',
+        help="Solve again only the puzzles in the database affected by changes to the dictionary since the last --batch.")
+
     parser.add_argument('-v', '--verbose', action='store_true',
         help="Be chatty about what is taking place.")
 
+    parser.add_argument('-w', '--write-back', action='store_true',
+        help="In single puzzle mode, if the puzzle is not in the database, add it.")
+
     myargs = parser.parse_args()
 
-    if not myargs.batch and not myargs.letters:
+    if not (myargs.batch or myargs.build or myargs.update or myargs.merge or myargs.letters):
         print("You must supply the --letters argument; 7 letters with the required letter first.")
         print("Use -h to get help.")
         sys.exit(os.EX_DATAERR)
 
     verbose = myargs.verbose
+    engine = myargs.engine
+    batch_size = myargs.batch_size
+    chunk_size = max(myargs.chunk_size, 1)
+    flush_interval = myargs.flush_interval
+    progress_interval = myargs.progress
+    schema = myargs.schema
+    shard_dir = myargs.shards
+    if schema == 'compact':
+        SQL = COMPACT_SQL
+        SCHEMA += COMPACT_SCHEMA
+        INDEXES += COMPACT_INDEXES
 
     try:
-        db = sqlitedb.SQLiteDB(myargs.db)
-        db.execute_SQL("pragma journal_mode=wal")
+        ###
+        # Looking up one puzzle only reads the database.
+        ###
+        read_only = not (myargs.batch or myargs.build or myargs.update or 
+            myargs.merge or myargs.write_back)
+        in_memory = myargs.batch and myargs.checkpoint > 0
+        db = sqlitedb.SQLiteDB(myargs.db, read_only=read_only, to_RAM=in_memory, 
+            checkpoint_interval=myargs.checkpoint,
+            progress=report_save if verbose else None)
+        if not db: raise sqlite3.OperationalError(myargs.db)
+        if not read_only:
+            db.execute_SQL("pragma journal_mode=wal")
+            create_schema()
     except:
         db = None
         print(f"{myargs.db} not found or is not a database.")
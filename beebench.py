@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the solver engines, the dictionary builder, and
+the database write path, run against the dictionaries that come
+with the project. The results are written as JSON, and they can
+be compared with the results of an earlier run:
+
+    python beebench.py --save baseline.json
+    ... change things ...
+    python beebench.py --baseline baseline.json --save new.json
+
+The comparison prints every metric, and the exit status is
+os.EX_DATAERR if any of them is worse than the baseline by more
+than --tolerance.
+"""
+
+import typing
+from   typing import *
+
+min_py = (3, 8)
+
+###
+# Standard imports, starting with os and sys
+###
+import os
+import sys
+if sys.version_info < min_py:
+    print(f"This program requires Python {min_py[0]}.{min_py[1]}, or higher.")
+    sys.exit(os.EX_SOFTWARE)
+
+###
+# Other standard distro imports
+###
+import argparse
+import json
+import platform
+import random
+import tempfile
+import time
+
+###
+# From hpclib
+###
+from   dorunrun import dorunrun
+import sqlitedb
+
+###
+# From this project
+###
+import bee
+
+###
+# Credits
+###
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2022'
+__credits__ = None
+__version__ = 0.1
+__maintainer__ = 'George Flanagin'
+__email__ = ['me@georgeflanagin.com', 'gflanagin@richmond.edu']
+__status__ = 'in progress'
+__license__ = 'MIT'
+
+here = os.path.dirname(os.path.realpath(__file__))
+default_datasets = ('20k.txt.bee', 'dukedict.txt.bee')
+default_engines = ('mask', 'subset', 'trie') + (('numpy',) if bee.we_have_numpy else ())
+
+# name -> {"value", "unit", "better"}, filled in by record().
+metrics = {}
+verbose = False
+
+
+def record(name:str, value:float, unit:str, better:str) -> None:
+    """
+    Keep one measurement. better is 'higher' or 'lower'.
+    """
+    global metrics
+    global verbose
+
+    metrics[name] = {"value":value, "unit":unit, "better":better}
+    verbose and print(f"{name:<55} {value:>14.2f} {unit}")
+
+
+def bench_single(dataset:str, engines:Iterable, num_puzzles:int, repeat:int) -> None:
+    """
+    Microseconds to solve one puzzle, for each engine. The puzzles
+    are pangram letter sets chosen at random, with a random middle
+    letter, the same ones for every engine.
+    """
+    words, masks = bee.load_dictionary(dataset)
+    letter_sets = sorted(bee.pangram_letter_sets(words, masks))
+    chooser = random.Random(len(letter_sets))
+    puzzles = [(letters, chooser.choice(letters))
+        for letters in chooser.choices(letter_sets, k=num_puzzles)]
+
+    for engine in engines:
+        bee.engine = engine
+        bee.prepare_engine(words, masks)
+        solver = bee.solvers[engine]
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for letters, middle in puzzles:
+                solver(middle, letters.replace(middle, ''), words, masks)
+            timings.append(time.perf_counter() - start)
+
+        record(f"single.{os.path.basename(dataset)}.{engine}",
+            1e6 * min(timings) / num_puzzles, "us/puzzle", "lower")
+
+
+def bench_batch(dataset:str, engines:Iterable, cpus:Iterable, repeat:int) -> None:
+    """
+    Pangrams per second for a complete batch run, with the database,
+    for each engine and number of cpus. Each run is a separate
+    bee.py, so the time includes starting it.
+    """
+    words, masks = bee.load_dictionary(dataset)
+    num_pangrams = sum(len(_) for _ in bee.pangram_letter_sets(words, masks).values())
+
+    for engine in engines:
+        for num_cpus in cpus:
+            timings = []
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as tmp:
+                    start = time.perf_counter()
+                    result = dorunrun([sys.executable, os.path.join(here, 'bee.py'),
+                        '--batch', '--engine', engine, '--cpus', num_cpus,
+                        '--db', os.path.join(tmp, 'bench.db'), '--dict', dataset],
+                        return_datatype=dict)
+                    timings.append(time.perf_counter() - start)
+                if not result['OK']:
+                    print(f"bee.py failed, and {engine=} {num_cpus=} is not recorded: {result['stderr']}")
+                    break
+            else:
+                record(f"batch.{os.path.basename(dataset)}.{engine}.cpus{num_cpus}",
+                    num_pangrams / min(timings), "pangrams/s", "higher")
+
+
+def bench_build(dataset:str, repeat:int) -> None:
+    """
+    Input words per second through build_dict(), which includes
+    writing the .bee and .bee.idx files.
+    """
+    with open(dataset) as f:
+        num_words = len(f.read().split())
+
+    timings = []
+    cwd = os.getcwd()
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                os.chdir(tmp)
+                start = time.perf_counter()
+                bee.build_dict(dataset)
+                timings.append(time.perf_counter() - start)
+            finally:
+                os.chdir(cwd)
+
+    record(f"build.{os.path.basename(dataset)}",
+        num_words / min(timings), "words/s", "higher")
+
+
+def bench_write(dataset:str, repeat:int) -> None:
+    """
+    Answer rows per second through flush_results(), the writer's
+    path to the database, in transactions of bee.batch_size rows,
+    inside a bulk load. The time includes building the indexes.
+    """
+    words, masks = bee.load_dictionary(dataset)
+    bee.engine = 'subset'
+    bee.prepare_engine(words, masks)
+    rows = [bee.answer_row(required_letter, puzzle, matches)
+        for puzzle in bee.pangram_letter_sets(words, masks)
+        for required_letter, matches in bee.solve_letter_set(puzzle, words, masks).items()]
+
+    timings = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            bee.db = sqlitedb.SQLiteDB(os.path.join(tmp, 'bench.db'))
+            bee.mylock = bee.db.lock
+            bee.db.execute_SQL("pragma journal_mode=wal")
+            bee.create_schema()
+
+            start = time.perf_counter()
+            with bee.db.bulk_load(bee.INDEXES):
+                for i in range(0, len(rows), bee.batch_size):
+                    bee.pending_answers = rows[i:i + bee.batch_size]
+                    bee.flush_results(force=True, in_bulk_load=True)
+            timings.append(time.perf_counter() - start)
+
+            bee.db.close()
+            bee.db = None
+
+    record(f"write.{os.path.basename(dataset)}",
+        len(rows) / min(timings), "rows/s", "higher")
+
+
+def compare(baseline:dict, tolerance:float) -> bool:
+    """
+    Print each metric beside its baseline. Returns False if any
+    of them has become worse by more than tolerance.
+    """
+    global metrics
+
+    OK = True
+    for name, m in sorted(metrics.items()):
+        old = baseline.get('metrics', {}).get(name)
+        if not old:
+            print(f"{name:<55} {m['value']:>14.2f} {m['unit']:<12} (new)")
+            continue
+
+        change = (m['value'] - old['value']) / old['value'] if old['value'] else 0.0
+        worse = -change if m['better'] == 'higher' else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        OK = OK and not flag
+        print(f"{name:<55} {m['value']:>14.2f} {m['unit']:<12} {change:+8.1%} {flag}")
+
+    return OK
+
+
+def beebench_main(myargs:argparse.Namespace) -> int:
+    """
+    Run what was asked for, save it, and compare it.
+    """
+    global metrics
+
+    datasets = [_ if os.path.isabs(_) else os.path.join(here, _) for _ in myargs.datasets]
+    for dataset in datasets:
+        'single' in myargs.only and bench_single(dataset, myargs.engines, myargs.puzzles, myargs.repeat)
+        'batch' in myargs.only and bench_batch(dataset, myargs.engines, myargs.cpus, myargs.repeat)
+        'build' in myargs.only and bench_build(dataset, myargs.repeat)
+        'write' in myargs.only and bench_write(dataset, myargs.repeat)
+
+    results = {"meta":{"when":time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "host":platform.node(), "python":platform.python_version(),
+            "cpu_count":os.cpu_count()},
+        "metrics":metrics}
+
+    if myargs.save:
+        with open(myargs.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if not myargs.baseline:
+        myargs.save or print(json.dumps(results, indent=2))
+        return os.EX_OK
+
+    with open(myargs.baseline) as f:
+        baseline = json.load(f)
+    return os.EX_OK if compare(baseline, myargs.tolerance) else os.EX_DATAERR
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog="beebench",
+        description="How fast does bee do what bee does best?")
+
+    parser.add_argument('--baseline', type=str, default="",
+        help="JSON from an earlier run to compare with.")
+
+    parser.add_argument('--cpus', type=int, nargs='+', default=[1, 2, 4],
+        help="numbers of cpus for the batch benchmarks.")
+
+    parser.add_argument('--datasets', type=str, nargs='+', default=list(default_datasets),
+        help="dictionaries to use.")
+
+    parser.add_argument('--engines', type=str, nargs='+', default=list(default_engines),
+        choices=tuple(bee.solvers),
+        help="engines to measure.")
+
+    parser.add_argument('--only', type=str, nargs='+',
+        default=['single', 'batch', 'build', 'write'],
+        choices=('single', 'batch', 'build', 'write'),
+        help="which benchmarks to run.")
+
+    parser.add_argument('--puzzles', type=int, default=200,
+        help="number of puzzles for the single puzzle benchmark.")
+
+    parser.add_argument('--repeat', type=int, default=3,
+        help="run each benchmark this many times, and keep the best.")
+
+    parser.add_argument('--save', type=str, default="",
+        help="write the results to this JSON file.")
+
+    parser.add_argument('--tolerance', type=float, default=0.10,
+        help="fraction by which a metric may be worse than the baseline.")
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="Print each result as it is measured.")
+
+    myargs = parser.parse_args()
+    verbose = myargs.verbose
+
+    sys.exit(beebench_main(myargs))
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+The compiled form of a .bee dictionary. The file is read with
+mmap, so opening it costs nothing in proportion to the number of
+words, and no Python str is created for a word until it is
+needed as an answer.
+
+Layout of a .bee.idx file, in the native byte order:
+
+    header  -- see HEADER below; 64 bytes.
+    offsets -- array('I') of count+1 byte offsets into the blob.
+    masks   -- array('I') of count letter masks.
+    blob    -- the UTF-8 words, one after the other, no separators.
+
+The words are stored sorted by their letter mask, so all the
+words with the same letters are adjacent.
+"""
+
+import typing
+from   typing import *
+
+min_py = (3, 8)
+
+###
+# Standard imports, starting with os and sys
+###
+import os
+import sys
+if sys.version_info < min_py:
+    print(f"This program requires Python {min_py[0]}.{min_py[1]}, or higher.")
+    sys.exit(os.EX_SOFTWARE)
+
+###
+# Other standard distro imports
+###
+from   array import array
+import hashlib
+import mmap
+import struct
+
+###
+# Credits
+###
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2022'
+__credits__ = None
+__version__ = 0.1
+__maintainer__ = 'George Flanagin'
+__email__ = ['me@georgeflanagin.com', 'gflanagin@richmond.edu']
+__status__ = 'in progress'
+__license__ = 'MIT'
+
+MAGIC = b'BEEIDX01'
+BYTE_ORDER_MARK = 0x01020304
+
+###
+# magic, byte order mark, word count, blob length, source size,
+# SHA-256 of the source .bee file, padding to 64 bytes.
+###
+HEADER = struct.Struct('=8sIIIQ32s4x')
+
+
+def checksum(filename:str) -> bytes:
+    """
+    SHA-256 of a file, read in pieces.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+def write_index(words:Sequence, masks:array, filename:str, source:str) -> int:
+    """
+    Write the compiled index of words to filename. masks[i] must
+    be the letter mask of words[i], and source is the name of the
+    .bee file the words came from. Returns the number of words.
+    """
+    order = sorted(range(len(words)), key=lambda i: masks[i])
+    return write_sorted_index(len(words), ((masks[i], words[i]) for i in order),
+        filename, source)
+
+
+def write_sorted_index(count:int, pairs:Iterable, filename:str, source:str, 
+    buffer_size:int=1 << 16) -> int:
+    """
+    Write the compiled index from count (mask, word) pairs that are 
+    already sorted by mask. The pairs are consumed buffer_size at a
+    time, and each of the three sections is written in place, so 
+    the memory used does not depend on count. Returns count.
+    """
+    itemsize = array('I').itemsize
+    offsets_at = HEADER.size
+    masks_at = offsets_at + (count + 1) * itemsize
+    blob_at = masks_at + count * itemsize
+
+    with open(filename, 'wb') as f:
+        written = offsets_written = blob_length = 0
+        offsets = array('I', [0])
+        sorted_masks = array('I')
+        blob = bytearray()
+
+        def flush() -> None:
+            nonlocal written, offsets_written, blob_length, offsets, sorted_masks, blob
+            f.seek(offsets_at + offsets_written * itemsize)
+            offsets.tofile(f)
+            offsets_written += len(offsets)
+            f.seek(masks_at + written * itemsize)
+            sorted_masks.tofile(f)
+            f.seek(blob_at + blob_length)
+            f.write(blob)
+            written += len(sorted_masks)
+            blob_length += len(blob)
+            offsets, sorted_masks, blob = array('I'), array('I'), bytearray()
+
+        for mask, word in pairs:
+            blob += word.encode('utf-8')
+            offsets.append(blob_length + len(blob))
+            sorted_masks.append(mask)
+            if len(sorted_masks) >= buffer_size: flush()
+        flush()
+
+        if written != count:
+            raise ValueError(f"{filename}: expected {count} words, and got {written}.")
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, BYTE_ORDER_MARK, count, blob_length,
+            os.path.getsize(source), checksum(source)))
+
+    return count
+
+
+class BeeIndex:
+    """
+    A read-only, memory mapped .bee.idx file. The object behaves
+    as a sequence of words, and the masks attribute is a sequence
+    of their letter masks in the same order.
+    """
+
+    __slots__ = ( 'name', 'f', 'mm', 'count', 'source_size', 'source_checksum',
+        'offsets', 'masks', 'blob_start' )
+
+    def __init__(self, filename:str):
+        """
+        Open and map the file. Raises ValueError if the file is not
+        an index written on a machine with our byte order.
+        """
+        self.name = filename
+        self.f = open(filename, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, bom, self.count, blob_length, self.source_size, \
+            self.source_checksum = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or bom != BYTE_ORDER_MARK:
+            self.close()
+            raise ValueError(f"{filename} is not a compatible .bee.idx file.")
+
+        itemsize = array('I').itemsize
+        start = HEADER.size
+        end = start + (self.count + 1) * itemsize
+        self.offsets = memoryview(self.mm)[start:end].cast('I')
+        start, end = end, end + self.count * itemsize
+        self.masks = memoryview(self.mm)[start:end].cast('I')
+        self.blob_start = end
+
+
+    def __len__(self) -> int:
+        return self.count
+
+
+    def __getitem__(self, i:Union[int, slice]) -> Union[str, tuple]:
+        if isinstance(i, slice):
+            return tuple(self[_] for _ in range(*i.indices(self.count)))
+        if i < 0: i += self.count
+        if not 0 <= i < self.count: raise IndexError(i)
+
+        return self.mm[self.blob_start + self.offsets[i]:
+            self.blob_start + self.offsets[i+1]].decode('utf-8')
+
+
+    def __iter__(self) -> Iterable:
+        for i in range(self.count):
+            yield self[i]
+
+
+    def close(self) -> None:
+        """
+        The memoryviews must be released before the map is closed.
+        """
+        for view in ('offsets', 'masks'):
+            try:
+                getattr(self, view).release()
+            except AttributeError:
+                pass
+        self.mm.close()
+        self.f.close()
+
+
+    def groups(self) -> dict:
+        """
+        Return mask -> range of the positions of the words having
+        that mask. Because the words are sorted by mask, each
+        group is a single run.
+        """
+        groups = {}
+        lower = 0
+        for i in range(1, self.count + 1):
+            if i == self.count or self.masks[i] != self.masks[lower]:
+                groups[self.masks[lower]] = range(lower, i)
+                lower = i
+        return groups
+
+
+    def matches(self, source:str) -> bool:
+        """
+        Is this index current with respect to its source file? If
+        the index is newer than the source, and the size is right,
+        we take it on faith. Otherwise, the checksum decides.
+        """
+        try:
+            info = os.stat(source)
+        except FileNotFoundError:
+            return True
+
+        if info.st_size != self.source_size: return False
+        if os.stat(self.name).st_mtime >= info.st_mtime: return True
+        return checksum(source) == self.source_checksum
+
+
+if __name__ == '__main__':
+
+    ###
+    # Compile existing .bee files:
+    #   python beeidx.py dukedict.txt.bee [...]
+    ###
+    import bee
+
+    for filename in sys.argv[1:]:
+        with open(filename) as f:
+            words = tuple(f.read().split())
+        n = write_index(words, bee.build_masks(words), f"{filename}.idx", filename)
+        print(f"{filename}.idx has {n} words.")
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+A solver that stays resident. The server loads each dictionary
+and its indexes once, and it answers puzzles over a Unix domain
+socket. The same file is the client.
+
+The conversation is one JSON object per line in each direction.
+A request looks like
+
+    {"letters": "george", "middle": "f", "dict": "dukedict.txt.bee"}
+
+and as with bee.py, "middle" may be omitted if the required letter
+is the first of the letters. "dict" is matched by the basename of the
+file, and it may be omitted to use the first dictionary the server
+loaded. If there is a "prefix", only the answers that start with it
+are returned, which is how hints are given. If the server was started
+with --db, puzzles for the default dictionary are looked up in 
+bee.answer_cache, and then in that results file, before they are 
+solved. The results file must have been made from the default
+dictionary; otherwise it is not used. The response is
+
+    {"OK": true, "middle": "f", "letters": "george", "words": [...]}
+
+or {"OK": false, "error": "..."}. A client may send any number of
+requests on one connection.
+"""
+
+import typing
+from   typing import *
+
+min_py = (3, 8)
+
+###
+# Standard imports, starting with os and sys
+###
+import os
+import sys
+if sys.version_info < min_py:
+    print(f"This program requires Python {min_py[0]}.{min_py[1]}, or higher.")
+    sys.exit(os.EX_SOFTWARE)
+
+###
+# Other standard distro imports
+###
+import argparse
+import json
+import signal
+import socket
+import socketserver
+import tempfile
+
+###
+# From hpclib
+###
+import sqlitedb
+
+###
+# From this project
+###
+import bee
+
+###
+# Credits
+###
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2022'
+__credits__ = None
+__version__ = 0.1
+__maintainer__ = 'George Flanagin'
+__email__ = ['me@georgeflanagin.com', 'gflanagin@richmond.edu']
+__status__ = 'in progress'
+__license__ = 'MIT'
+
+default_socket = os.path.join(tempfile.gettempdir(), f"bee.{os.getuid()}.sock")
+
+# name -> (words, groups, trie) for each dictionary the server has loaded.
+# The first one loaded is the default.
+dictionaries = {}
+default_dict = None
+verbose = False
+
+# A read-only SQLiteDB of batch results; each handler thread borrows
+# a connection from its pool.
+db = None
+
+
+def answer(request:dict) -> dict:
+    """
+    Solve the puzzle in one request, and build the response.
+    """
+    global dictionaries
+    global default_dict
+    global db
+
+    try:
+        letters = str(request.get('letters') or '').lower()
+        middle = str(request.get('middle') or '').lower()
+        if not middle:
+            middle, letters = letters[:1], letters[1:]
+
+        if len(middle) != 1 or not letters:
+            return {"OK":False, "error":"letters and a single middle letter are required."}
+        if any(c not in bee.letter_bits for c in middle + letters):
+            return {"OK":False, "error":"only the letters a-z may be used."}
+
+        # Dictionaries are known by the basenames of their files.
+        name = os.path.basename(request.get('dict') or default_dict)
+        if name not in dictionaries:
+            return {"OK":False, "error":f"no dictionary named {name}."}
+
+        words, groups, trie = dictionaries[name]
+        prefix = str(request.get('prefix') or '').lower()
+        if db and not prefix and name == default_dict:
+            matches = bee.lookup_answers("".join(sorted(set(middle + letters))), middle, db)
+            if matches is not None:
+                return {"OK":True, "middle":middle, "letters":letters, "words":matches}
+
+        if prefix:
+            matches = bee.trie_solve(middle, letters, prefix=prefix, trie=trie)
+        else:
+            matches = bee.subset_solve(middle, letters, words, groups=groups)
+        return {"OK":True, "middle":middle, "letters":letters, "words":sorted(matches)}
+
+    except Exception as e:
+        return {"OK":False, "error":str(e)}
+
+
+def load(filename:str) -> str:
+    """
+    Load a dictionary, group it by mask, and build its trie. The 
+    name clients use is the basename of the file.
+    """
+    global dictionaries
+    global default_dict
+
+    words, masks = bee.load_dictionary(filename)
+    name = os.path.basename(filename)
+    dictionaries[name] = (words, bee.group_by_mask(words, masks), bee.build_trie(words))
+    default_dict = default_dict or name
+    return name
+
+
+class BeeHandler(socketserver.StreamRequestHandler):
+    """
+    Answer requests, one per line, until the client hangs up.
+    """
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                response = answer(json.loads(line))
+            except json.JSONDecodeError as e:
+                response = {"OK":False, "error":f"bad JSON: {e}"}
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class BeeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def ask(requests:Iterable, socket_path:str=default_socket) -> Iterable:
+    """
+    Generator that sends each request over one connection, and
+    yields the responses in order.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile('rwb') as f:
+            for request in requests:
+                f.write(json.dumps(request).encode('utf-8') + b'\n')
+                f.flush()
+                yield json.loads(f.readline())
+
+
+def serve(myargs:argparse.Namespace) -> int:
+    """
+    Load the dictionaries and answer until interrupted.
+    """
+    global verbose
+    global db
+
+    if myargs.db:
+        db = sqlitedb.SQLiteDB(myargs.db, read_only=True, pool_size=myargs.pool_size)
+        bee.schema = myargs.schema
+        if not db:
+            print(f"Cannot read {myargs.db}")
+            return os.EX_NOINPUT
+
+    for filename in myargs.dict:
+        name = load(filename)
+        verbose and print(f"Loaded {name} with {len(dictionaries[name][0])} words.")
+
+    # The answers in db are only good for the dictionary they were made from.
+    if db and bee.recorded_checksum(db) != bee.dictionary_checksum(myargs.dict[0]):
+        print(f"{myargs.db} was not made from {myargs.dict[0]}; it will not be used.")
+        db = None
+
+    if os.path.exists(myargs.socket):
+        os.unlink(myargs.socket)
+
+    # Let kill (SIGTERM) take the same path out as control-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(os.EX_OK))
+
+    with BeeServer(myargs.socket, BeeHandler) as server:
+        print(f"Serving {tuple(dictionaries)} on {myargs.socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt as e:
+            print("You pressed control-C")
+        finally:
+            os.unlink(myargs.socket)
+
+    return os.EX_OK
+
+
+def beeserver_main(myargs:argparse.Namespace) -> int:
+    """
+    Either serve, or be a client for one puzzle.
+    """
+    if myargs.serve:
+        return serve(myargs)
+
+    request = {"letters":myargs.letters, "middle":myargs.middle,
+        "dict":myargs.dict[0] if myargs.dict else None, "prefix":myargs.prefix}
+    try:
+        response = next(ask((request,), myargs.socket))
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        print(f"No server is listening on {myargs.socket}")
+        return os.EX_UNAVAILABLE
+
+    if not response['OK']:
+        print(response['error'])
+        return os.EX_DATAERR
+
+    print(response['words'])
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog="beeserver",
+        description="What bee does, bee does best, and it does it over and over.")
+
+    parser.add_argument('--db', type=str, default="",
+        help="A database written by bee.py --batch with the default dictionary, opened read-only.")
+
+    parser.add_argument('-d', '--dict', type=str, action='append', default=[],
+        help="Name of a dictionary file. The server may load several, and the first is the default.")
+
+    parser.add_argument('-l', '--letters', type=str,
+        help="Letters to use, either six letters, or seven with the required letter first.")
+
+    parser.add_argument('-m', '--middle', type=str,
+        help="Middle letter")
+
+    parser.add_argument('-p', '--prefix', type=str, default="",
+        help="Only the answers that start with this; a hint.")
+
+    parser.add_argument('--pool-size', type=int, default=8,
+        help="database connections kept for the handler threads (default:8).")
+
+    parser.add_argument('--schema', type=str, default='text', choices=('text', 'compact'),
+        help="The schema of --db (default:text).")
+
+    parser.add_argument('--serve', action='store_true',
+        help="Run the server rather than the client.")
+
+    parser.add_argument('--socket', type=str, default=default_socket,
+        help=f"The Unix domain socket (default:{default_socket}).")
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="Be chatty about what is taking place.")
+
+    myargs = parser.parse_args()
+    verbose = myargs.verbose
+
+    if myargs.serve and not myargs.dict:
+        myargs.dict = [bee.default_word_list]
+
+    if not myargs.serve and not myargs.letters:
+        print("You must supply the --letters argument; 7 letters with the required letter first.")
+        print("Use -h to get help.")
+        sys.exit(os.EX_DATAERR)
+
+    sys.exit(beeserver_main(myargs))
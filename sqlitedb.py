@@ -23,11 +23,22 @@ import typing
 from   typing import *
 
 import os
-import multiprocessing
+import contextlib
+import functools
+import queue
+import re
 import sqlite3
 import sys
 import tempfile
+import threading
 import time
+import urllib.parse
+
+try:
+    import fcntl
+    we_have_fcntl = True
+except ImportError as e:
+    we_have_fcntl = False
 
 try:
     import pandas
@@ -39,6 +50,107 @@ from dorunrun import dorunrun
 from urdecorators import trap
 
 
+@functools.lru_cache(maxsize=256)
+def is_select(SQL:str) -> bool:
+    """
+    Is this a statement that returns rows? The answer is cached,
+    because the same statements are run over and over.
+    """
+    return SQL.strip().lower().startswith('select')
+
+
+def open_handles(filename:str) -> int:
+    """
+    Count the file descriptors, in all the processes we can see, that 
+    refer to filename. This is what lsof would report, without the
+    subprocess. The processes of other users are not visible unless
+    we are root, but neither are they to lsof.
+    """
+    target = os.stat(filename)
+    n = 0
+    for proc in os.scandir('/proc'):
+        if not proc.name.isdigit(): continue
+        try:
+            fds = os.scandir(f"/proc/{proc.name}/fd")
+        except OSError as e:
+            # Gone, or not ours.
+            continue
+
+        with fds:
+            for fd in fds:
+                try:
+                    info = os.stat(fd.path)
+                except OSError as e:
+                    continue
+                n += info.st_ino == target.st_ino and info.st_dev == target.st_dev
+
+    return n
+
+
+class ProcessLock:
+    """
+    A reentrant lock that excludes the other threads in this process,
+    and the other processes, whether they are our children or not.
+    Between processes, it is an flock() on a file beside the database.
+    A child process that inherits the lock gets its own open file 
+    description the first time it acquires it, because a description
+    shared across fork() would not exclude anything.
+
+    Where there is no fcntl, or the lock file cannot be created, the
+    lock only works between threads.
+    """
+
+    __slots__ = ( 'path', 'pid', 'fd', 'rlock', 'depth' )
+
+    def __init__(self, path:str):
+        self.path = path
+        self.pid = None
+        self.fd = None
+        self.rlock = None
+        self.depth = 0
+
+
+    def _check_pid(self) -> None:
+        if self.pid == os.getpid(): return
+
+        if self.fd is not None:
+            os.close(self.fd)
+        self.pid = os.getpid()
+        self.fd = None
+        self.rlock = threading.RLock()
+        self.depth = 0
+
+
+    def acquire(self) -> bool:
+        self._check_pid()
+        self.rlock.acquire()
+        try:
+            if not self.depth and we_have_fcntl:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except OSError as e:
+            # No lock file; the thread lock is all we have.
+            pass
+        self.depth += 1
+        return True
+
+
+    def release(self) -> None:
+        self.depth -= 1
+        if not self.depth and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.rlock.release()
+
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
 class SQLiteDB:
     """
     Basic functions for manipulating all sqlite3 databases. Here is
@@ -57,12 +169,64 @@ class SQLiteDB:
     to_RAM -- if True, the entire database is read into RAM on open,
         and the close() operation will write it back to wherever it
         came from. (default:False)
+
+    checkpoint_interval, checkpoint_rows -- with to_RAM, save a copy
+        to <database>.checkpoint at the first commit after this many
+        seconds, or after this many rows have been changed. Zero means
+        never. If the checkpoint is newer than the database when it 
+        is opened, the checkpoint is what is read. close() removes it.
+        (default:0, 0)
+
+    checkpoint_pages -- pages copied per step when saving. (default:1024)
+
+    progress -- None, or a function called after each step of a save
+        with the arguments (status, remaining, total) that backup()
+        gives it. (default:None)
+
+    read_only -- if True, open with a file: URI in mode=ro, and set
+        query_only and mmap_size on every connection, including the
+        ones in the pool. Nothing is written, so nothing is locked
+        but the database's own read locks. (default:False)
+
+    immutable -- with read_only, promise SQLite that no one will 
+        change the file while it is open, so that it takes no locks
+        at all. Only for a results file that is finished. (default:False)
+
+    shared_cache -- with read_only, let the connections in this 
+        process share one page cache. (default:False)
+
+    mmap_size -- bytes of the file to map, with read_only. (default:1GiB)
+
+    pool_size -- the most idle connections kept for connection(),
+        the pool used by threaded callers. (default:4)
+
+    arraysize -- the number of rows iter_SQL() fetches at a time.
+        (default:1000)
+
+    cached_statements -- the number of compiled statements each
+        connection keeps, so that a statement that is run again
+        with different parameters is not prepared again. (default:256)
+
+    The object may be used on either side of a fork(). The connection
+    belongs to the process that opened it, and a child process opens
+    its own the first time it uses db or cursor. The inherited one is
+    kept, but never used or closed, because closing it in the child 
+    could disturb the parent's locks. A to_RAM database has no files 
+    open, so a child keeps using its copy of the parent's.
     """
 
-    __slots__ = ( 'stmt', 'OK', 'db', 'cursor', 
-        'timeout', 'isolation_level', 'name', 'use_pandas', 'to_RAM', 'lock' )
+    __slots__ = ( 'stmt', 'OK', '_db', '_cursor', 
+        'timeout', 'isolation_level', 'name', 'use_pandas', 'to_RAM', 'lock',
+        'pid', 'pool', 'pool_size', 'inherited', 'arraysize', 'cached_statements',
+        'checkpoint_interval', 'checkpoint_rows', 'checkpoint_pages', 'progress',
+        'rows_since_checkpoint', 'last_checkpoint',
+        'read_only', 'immutable', 'shared_cache', 'mmap_size' )
     __values__ = ( '', False, None, None,
-        15, 'DEFERRED', '', True, False, multiprocessing.RLock() )
+        15, 'DEFERRED', '', True, False, None,
+        None, None, 4, None, 1000, 256, 
+        0, 0, 1024, None,
+        0, 0,
+        False, False, False, 1 << 30 )
     __defaults__ = dict(zip(
         __slots__, __values__
         ))
@@ -86,19 +250,46 @@ class SQLiteDB:
             if k in SQLiteDB.__slots__:
                 setattr(self, k, v)
 
+        self.lock = ProcessLock(f"{self.name}.lock")
+        self.inherited = []
+        self.connect()
+
+
+    def connect(self) -> bool:
+        """
+        Open this process's connection. Anything opened by another 
+        process is set aside rather than closed.
+        """
+        if self.pid is not None and self.pid != os.getpid():
+            self.inherited.append((None if self.to_RAM else self._db, self.pool))
+            if self.to_RAM and self._db is not None:
+                self.pid = os.getpid()
+                self.pool = queue.LifoQueue()
+                return self.OK
+
+        self.pid = os.getpid()
+        self.pool = queue.LifoQueue()
+        self._db = self._cursor = None
+        self.rows_since_checkpoint = 0
+        self.last_checkpoint = time.time()
+
         error_on_init = True
         try:
-            self.db = sqlite3.connect(self.name, 
-                timeout=self.timeout, isolation_level=self.isolation_level)
+            self._db = self.new_connection()
 
             if self.to_RAM:
-                memDB = sqlite3.connect(':memory:')
-                self.db.backup(memDB, pages=0, progress=None)
-                self.db.close()
-                self.db = memDB
+                source = self._db
+                if self.has_checkpoint():
+                    sys.stderr.write(f"Restoring {self.name} from {self.checkpoint_name}\n")
+                    source = sqlite3.connect(self.checkpoint_name)
+                memDB = sqlite3.connect(':memory:', isolation_level=self.isolation_level)
+                source.backup(memDB, pages=0, progress=None)
+                source is self._db or source.close()
+                self._db.close()
+                self._db = memDB
                 
-            self.cursor = self.db.cursor()
-            self.keys_on()
+            self._cursor = self._db.cursor()
+            self.read_only or self.keys_on()
             error_on_init = False
 
         except sqlite3.OperationalError as e:
@@ -107,6 +298,131 @@ class SQLiteDB:
         finally:
             self.OK = not error_on_init
 
+        return self.OK
+
+
+    @property
+    def checkpoint_name(self) -> str:
+        return f"{self.name}.checkpoint"
+
+
+    def has_checkpoint(self) -> bool:
+        """
+        Is there a checkpoint at least as new as the database?
+        """
+        try:
+            return (not os.path.exists(self.name) or
+                os.stat(self.checkpoint_name).st_mtime >= os.stat(self.name).st_mtime)
+        except FileNotFoundError as e:
+            return False
+
+
+    def checkpoint_due(self) -> bool:
+        """
+        Has it been long enough, or have enough rows changed?
+        """
+        return self.to_RAM and (
+            (self.checkpoint_rows and self.rows_since_checkpoint >= self.checkpoint_rows) or
+            (self.checkpoint_interval and 
+                time.time() - self.last_checkpoint >= self.checkpoint_interval))
+
+
+    def checkpoint(self) -> None:
+        """
+        Save the in-memory database to the checkpoint file. Call this
+        between transactions; commit() does so when one is due.
+        """
+        self.save(self.checkpoint_name)
+        self.rows_since_checkpoint = 0
+        self.last_checkpoint = time.time()
+
+
+    def save(self, filename:str) -> None:
+        """
+        Copy the database to filename, checkpoint_pages at a time. 
+        The copy is made in a temporary file in the same directory,
+        and moved into place, so filename is always either the old
+        copy or the new one.
+        """
+        db_dir, _ = os.path.split(filename)
+        temp_db_name = os.path.join(db_dir,
+            next(tempfile._get_candidate_names()))
+
+        try:
+            temp_db = sqlite3.connect(temp_db_name)
+            self.db.backup(temp_db, pages=self.checkpoint_pages, progress=self.progress)
+            temp_db.close()
+            os.replace(temp_db_name, filename)
+
+        finally:
+            os.path.exists(temp_db_name) and os.unlink(temp_db_name)
+
+
+    def new_connection(self, **kwargs) -> sqlite3.Connection:
+        """
+        A connection to the file with our settings. 
+        """
+        if not self.read_only:
+            return sqlite3.connect(self.name, 
+                timeout=self.timeout, isolation_level=self.isolation_level, 
+                cached_statements=self.cached_statements, **kwargs)
+
+        options = {'mode':'ro'}
+        self.immutable and options.update(immutable=1)
+        self.shared_cache and options.update(cache='shared')
+        uri = f"file:{urllib.parse.quote(self.name)}?{urllib.parse.urlencode(options)}"
+
+        conn = sqlite3.connect(uri, uri=True,
+            timeout=self.timeout, isolation_level=self.isolation_level, 
+            cached_statements=self.cached_statements, **kwargs)
+        conn.execute('pragma query_only = 1')
+        conn.execute(f'pragma mmap_size = {self.mmap_size}')
+        return conn
+
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """
+        This process's connection, opened if this is a new process.
+        """
+        if self.pid != os.getpid(): self.connect()
+        return self._db
+
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        if self.pid != os.getpid(): self.connect()
+        return self._cursor
+
+
+    @contextlib.contextmanager
+    def connection(self) -> sqlite3.Connection:
+        """
+        Borrow a connection for the duration of a with statement. 
+        Each thread that uses this gets a connection of its own, 
+        which goes back in the pool when the thread is done with 
+        it. The pool belongs to this process, like db does. With
+        read_only, this is how many threads query at once.
+
+            with db.connection() as conn:
+                conn.execute(...)
+        """
+        if self.pid != os.getpid(): self.connect()
+        pool = self.pool
+        try:
+            conn = pool.get_nowait()
+        except queue.Empty as e:
+            # The pool guarantees one thread at a time.
+            conn = self.new_connection(check_same_thread=False)
+
+        try:
+            yield conn
+        finally:
+            if pool.qsize() < self.pool_size:
+                pool.put(conn)
+            else:
+                conn.close()
+
 
     def __str__(self) -> str:
         """ For simplicity """
@@ -119,7 +435,7 @@ class SQLiteDB:
         We consider everything "OK" if the object is attached to an open 
         database, and the last operation went well.
         """
-        return self.db is not None and self.OK
+        return self._db is not None and self.OK
 
 
     def __call__(self) -> sqlite3.Cursor:
@@ -150,7 +466,10 @@ class SQLiteDB:
         if not self.name: return -1
         if not os.path.exists(self.name): return -1
 
-        return max(len(dorunrun(f"lsof {self.name}", return_datatype=str).split()) - 1, 0)
+        if not os.path.isdir('/proc/self/fd'):
+            return max(len(dorunrun(f"lsof {self.name}", return_datatype=str).split()) - 1, 0)
+
+        return open_handles(self.name)
         
     
     def __invert__(self) -> int:
@@ -172,6 +491,68 @@ class SQLiteDB:
         self.cursor.execute('pragma synchronous = FULL')
 
 
+    @contextlib.contextmanager
+    def bulk_load(self, indexes:Iterable=(), **kwargs) -> object:
+        """
+        Load a lot of rows quickly, and put things back afterwards.
+
+            with db.bulk_load(INDEXES):
+                db.executemany_SQL(...)
+
+        On the way in, the pragmas are set for throughput, the indexes 
+        named in the CREATE INDEX statements in indexes are dropped, 
+        and one transaction is begun. On the way out, the transaction
+        is committed (or rolled back if there was an exception), the
+        indexes are created again, ANALYZE is run, the WAL is 
+        checkpointed, and the pragmas are restored. The caller may 
+        commit and begin again inside; the pragmas and the missing
+        indexes last until the end.
+
+        journal_mode -- (default:wal)
+        cache_size   -- in the units of the pragma; negative is KiB.
+            (default:-262144, i.e., 256MiB)
+        temp_store   -- (default:memory)
+        mmap_size    -- bytes (default:1GiB)
+        """
+        pragmas = {'journal_mode':kwargs.get('journal_mode', 'wal'), 
+            'synchronous':'OFF',
+            'cache_size':kwargs.get('cache_size', -262144),
+            'temp_store':kwargs.get('temp_store', 'memory'),
+            'mmap_size':kwargs.get('mmap_size', 1 << 30)}
+        # Not every pragma applies to every database; mmap_size has
+        # no value for one in memory.
+        saved = {pragma:self.cursor.execute(f"pragma {pragma}").fetchone()
+            for pragma in pragmas}
+        saved = {pragma:value[0] for pragma, value in saved.items() if value}
+
+        self.commit()
+        for pragma, value in pragmas.items():
+            pragma in saved and self.cursor.execute(f"pragma {pragma} = {value}")
+
+        indexes = tuple(indexes)
+        for statement in indexes:
+            name = re.search(r'index\s+(?:if\s+not\s+exists\s+)?(\S+)', statement, re.I)
+            name and self.cursor.execute(f"DROP INDEX IF EXISTS {name.group(1)}")
+
+        self.cursor.execute("BEGIN IMMEDIATE TRANSACTION")
+        try:
+            yield self
+            self.db.commit()
+
+        except:
+            self.db.rollback()
+            raise
+
+        finally:
+            for statement in indexes:
+                self.cursor.execute(statement)
+            self.cursor.execute("ANALYZE")
+            self.db.commit()
+            self.cursor.execute("pragma wal_checkpoint(TRUNCATE)")
+            for pragma, value in saved.items():
+                self.cursor.execute(f"pragma {pragma} = {value}")
+
+
     @trap
     def close(self) -> bool:
         """
@@ -179,8 +560,15 @@ class SQLiteDB:
         resident database to disc. 
         """
 
-        # Commit any pending transactions.
+        # Nothing to do if this process never used the connection.
+        if self.pid != os.getpid(): 
+            self.OK = False
+            return True
+
+        # Commit any pending transactions, and empty the pool.
         self.commit()
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
 
         # First, check to see if other processes have the
         # the database open.
@@ -191,22 +579,11 @@ class SQLiteDB:
             return False if not self.db else self.db.close()
 
         else:
-            # Let's not overwrite the existing DB until
-            # we have saved the in-memory data.
-            db_dir, _ = os.path.split(self.name)
-            temp_db_name = os.path.join(db_dir,
-                next(tempfile._get_candidate_names()))
-
+            # save() does not overwrite the existing DB until
+            # it has the in-memory data.
             try:
-                # Create a new DB that is empty, and run backup
-                # to it.
-                temp_db = sqlite3.connect(temp_db_name)
-                self.db.backup(temp_db, pages=0, progress=None)
-
-                # Delete the original database.
-                os.unlink(self.name)
-                # Create a link to it.
-                os.link(temp_db_name, self.name)
+                self.save(self.name)
+                os.path.exists(self.checkpoint_name) and os.unlink(self.checkpoint_name)
 
             except Exception as e:
                 print(f"Exception raised saving in-memory database.\n{e=}")  
@@ -218,7 +595,6 @@ class SQLiteDB:
             finally:
                 self.OK = False
                 self.db.close()
-                os.unlink(temp_db_name)
 
 
     @trap
@@ -230,6 +606,7 @@ class SQLiteDB:
         try:
             with self.lock:
                 self.db.commit()
+            self.checkpoint_due() and self.checkpoint()
             return True
 
         except:
@@ -250,10 +627,10 @@ class SQLiteDB:
         global we_have_pandas
        
         docommit = kwargs.get('transaction') is True
-        is_select = SQL.strip().lower().startswith('select')
+        rows_back = is_select(SQL)
         has_args = not not args
 
-        if we_have_pandas and self.use_pandas and is_select:
+        if we_have_pandas and self.use_pandas and rows_back:
             return pandas.read_sql_query(SQL, self.db, *args)
         
         if has_args:
@@ -261,11 +638,54 @@ class SQLiteDB:
         else:
             rval = self.cursor.execute(SQL)
 
-        if is_select: return rval.fetchall()
+        if rows_back: return rval.fetchall()
+        self.rows_since_checkpoint += max(rval.rowcount, 0)
         docommit and self.commit()
         return rval
 
 
+    def iter_SQL(self, SQL:str, *args, **kwargs) -> Iterable:
+        """
+        Generator for the results of a SELECT that never holds more 
+        than arraysize rows in memory. It has its own cursor, so other
+        statements may be run while it is being read.
+
+        arraysize -- rows to fetch at a time (default:self.arraysize)
+        batches   -- if True, yield lists of up to arraysize rows 
+            rather than one row at a time.
+        """
+        cursor = self.db.cursor()
+        cursor.arraysize = kwargs.get('arraysize') or self.arraysize
+        batches = kwargs.get('batches') is True
+
+        try:
+            cursor.execute(SQL, args)
+            while True:
+                rows = cursor.fetchmany()
+                if not rows: break
+                if batches:
+                    yield rows
+                else:
+                    yield from rows
+        finally:
+            cursor.close()
+
+
+
+    @trap
+    def executemany_SQL(self, SQL:str, rows:Iterable, **kwargs) -> int:
+        """
+        Run one DML statement for each tuple in rows, with a single
+        call to the driver. Returns the number of rows affected.
+
+        transaction -- if True, commit when done.
+        """
+        docommit = kwargs.get('transaction') is True
+        rval = self.cursor.executemany(SQL, rows)
+        self.rows_since_checkpoint += max(rval.rowcount, 0)
+        docommit and self.commit()
+        return rval.rowcount
+
 
     def row_one(self, SQL:str, parameters:Union[tuple, None]=None) -> dict:
         """